@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+from time import time
+__author__ = 'adamkoziol'
+
+
+def fastqrecords(reads, length):
+    """
+    Create reproducible synthetic fastq records
+    :param reads: the number of reads to create
+    :param length: the length of each read
+    :return: the records as bytes
+    """
+    from random import Random
+    random = Random(reads * length)
+    records = list()
+    for read in range(reads):
+        sequence = ''.join(random.choice('ACGT') for _ in range(length))
+        quality = ''.join(random.choice('#5?FIJ') for _ in range(length))
+        records.append('@SYNTHETIC:{}\n{}\n+\n{}\n'.format(read, sequence, quality))
+    return ''.join(records).encode()
+
+
+def generate(path, samples, runs, reads, length, naming):
+    """
+    Create a directory of gzipped paired fastq files, and a matching seq ID file. All the files share the same
+    compressed contents, so that even very large corpora are quick to create
+    :param path: the directory in which to create the files
+    :param samples: the number of merged samples
+    :param runs: the number of runs (seq IDs) to merge for each sample
+    :param reads: the number of reads in each fastq file
+    :param length: the length of each read
+    :param naming: format of the seq IDs, with a single {} for the number of the run
+    :return: the number of fastq files created, and their total size
+    """
+    import gzip
+    os.makedirs(path, exist_ok=True)
+    payload = gzip.compress(fastqrecords(reads, length))
+    files = 0
+    with open(os.path.join(path, 'IDs.txt'), 'w') as idfile:
+        for sample in range(samples):
+            seqids = [naming.format(sample * runs + run) for run in range(runs)]
+            idfile.write(' '.join(seqids) + '\n')
+            for seqid in seqids:
+                for read in ['R1', 'R2']:
+                    with open(os.path.join(path, '{}_S1_L001_{}_001.fastq.gz'.format(seqid, read)), 'wb') as fastq:
+                        fastq.write(payload)
+                    files += 1
+    return files, files * len(payload)
+
+
+def throttle(rate):
+    """
+    Simulate slow storage by limiting the total throughput of the copies made by the merger to :rate MB/s. The limit is
+    shared by all the concurrent copies, like the bandwidth of a saturated NAS. Only the kernel copies of native
+    concatenation are limited; recompression, read statistics, and the shell backend read the files another way
+    :param rate: the maximum total throughput of the copies in MB/s
+    """
+    import threading
+    import time
+    import merger
+    copyrange = merger.copyrange
+    lock = threading.Lock()
+    # The time at which the storage has finished transferring all the data copied so far
+    free = [0]
+
+    def throttled(source, destination, size):
+        start = time.time()
+        copied = copyrange(source, destination, size)
+        # The copy gets the storage once the earlier copies are done with it, and then holds it for as long as its
+        # data takes at the limited rate
+        with lock:
+            free[0] = max(free[0], start) + copied / (rate * 1048576)
+            finish = free[0]
+        time.sleep(max(0, finish - time.time()))
+        return copied
+    merger.copyrange = throttled
+
+
+def startup(homepath):
+    """
+    :param homepath: the directory containing merger.py
+    :return: the number of seconds a fresh interpreter takes to import merger.py
+    """
+    import subprocess
+    start = time()
+    subprocess.check_call([sys.executable, '-c', 'import merger'], cwd=homepath)
+    return time() - start
+
+
+def benchmark(path, arguments):
+    """
+    Run the merger over the files in the path, and time each stage
+    :param path: the directory containing the fastq files and the seq ID file
+    :param arguments: dictionary of any additional arguments to pass to the merger
+    :return: dictionary of the number of seconds each stage took
+    """
+    from contextlib import redirect_stdout
+    import merger
+    stages = dict()
+
+    def timed(name, method):
+        def wrapper(self):
+            start = time()
+            method(self)
+            stages[name] = time() - start
+        return wrapper
+
+    # Time each of the stages of an otherwise unchanged run of the merger
+    timedmerger = type('TimedMerger', (merger.Merger,), {name: timed(name, getattr(merger.Merger, name))
+                                                         for name in ['idseek', 'idfind', 'idmerge', 'filelink']})
+    args = {'path': path, 'f': 'IDs.txt', 'd': 'space', 'Sort': False, 'linkFiles': True, 'relativePaths': False,
+            'copy': False, 'o': 'benchmark', 'a': os.path.join(path, 'assemblies'), 'samplesheet': False}
+    args.update(arguments)
+    start = time()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        try:
+            timedmerger(args, start)
+        except SystemExit:
+            pass
+    stages['total'] = time() - start
+    return stages
+
+
+def compare(results, previousfile):
+    """
+    Print the change in the time of each stage relative to a previous set of results
+    :param results: list of the current results
+    :param previousfile: the name and path of the JSON file of the previous results
+    """
+    with open(previousfile) as previous:
+        previous = {result['files']: result for result in json.load(previous)['results']}
+    for result in results:
+        if result['files'] not in previous:
+            continue
+        for stage, seconds in sorted(result['stages'].items()):
+            before = previous[result['files']]['stages'].get(stage)
+            if before:
+                print('{:>8} files {:>9}: {:8.3f} s -> {:8.3f} s ({:+.1f}%)'
+                      .format(result['files'], stage, before, seconds, 100 * (seconds - before) / before))
+
+
+def main(args):
+    """
+    Generate a corpus at each scale, and benchmark the merger against it
+    :param args: the parsed arguments
+    """
+    import platform
+    import shutil
+    import tempfile
+    homepath = os.path.split(os.path.abspath(__file__))[0]
+    sys.path.insert(0, homepath)
+    if args.throttle:
+        throttle(args.throttle)
+    arguments = {'backend': args.backend, 'recompress': args.recompress, 'threads': args.threads}
+    results = list()
+    for scale in args.scales:
+        # Each sample has a forward and a reverse file for each of its runs
+        samples = max(1, scale // (2 * args.runs))
+        path = tempfile.mkdtemp(prefix='merger_benchmark_', dir=args.workdir)
+        try:
+            start = time()
+            files, size = generate(path, samples, args.runs, args.reads, args.length, args.naming)
+            print('Created {} files ({} bytes) for {} samples in {:.1f} s'.format(files, size, samples, time() - start))
+            stages = benchmark(path, arguments)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+        print('  ' + ', '.join('{}: {:.3f} s'.format(stage, seconds) for stage, seconds in sorted(stages.items())))
+        results.append({'files': files, 'samples': samples, 'runs': args.runs, 'bytes': size, 'stages': stages})
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'arguments': vars(args),
+              'startup': startup(homepath), 'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=4, sort_keys=True)
+    print('Importing merger.py takes {:.3f} s. Results written to {}'.format(report['startup'], args.output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+# If the script is called from the command line, then call the argument parser
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    # Parser for arguments
+    parser = ArgumentParser(description='Benchmarks each stage of the merger against synthetic fastq files')
+    parser.add_argument('-s',
+                        '--scales',
+                        type=int,
+                        nargs='+',
+                        default=[100, 10000, 100000],
+                        help='The number of fastq files to create for each benchmark. Default is 100 10000 100000')
+    parser.add_argument('-r',
+                        '--runs',
+                        type=int,
+                        default=2,
+                        help='The number of runs merged into each sample. Default is 2')
+    parser.add_argument('-n',
+                        '--reads',
+                        type=int,
+                        default=100,
+                        help='The number of reads in each fastq file. Default is 100')
+    parser.add_argument('-l',
+                        '--length',
+                        type=int,
+                        default=150,
+                        help='The length of each read. Default is 150')
+    parser.add_argument('--naming',
+                        default='2016-SEQ-{:06d}',
+                        help='Format of the synthetic seq IDs. Default is 2016-SEQ-{:06d}')
+    parser.add_argument('-w',
+                        '--workdir',
+                        help='The directory in which to create the synthetic files. Default is the system temporary '
+                             'directory. Use a directory on the storage to be benchmarked')
+    parser.add_argument('--throttle',
+                        type=float,
+                        help='Simulate slow storage by limiting the total throughput of all the concurrent copies '
+                             'to this many MB/s, as the bandwidth of a single NAS would. Only native concatenation '
+                             'copies the files, so this cannot be used with --backend shell or --recompress')
+    parser.add_argument('-b',
+                        '--backend',
+                        choices=['native', 'shell'],
+                        default='native',
+                        help='The method the merger uses to concatenate the files. Default is native')
+    parser.add_argument('--recompress',
+                        action='store_true',
+                        help='Benchmark the BGZF recompression mode')
+    parser.add_argument('-t',
+                        '--threads',
+                        type=int,
+                        help='The maximum number of files to merge at the same time')
+    parser.add_argument('-o',
+                        '--output',
+                        default='benchmark.json',
+                        help='The name and path of the JSON file of results. Default is benchmark.json')
+    parser.add_argument('-c',
+                        '--compare',
+                        help='A JSON file of previous results to compare against')
+    arguments = parser.parse_args()
+    if arguments.throttle and (arguments.backend != 'native' or arguments.recompress):
+        parser.error('--throttle only limits native concatenation, so it cannot be used with --backend shell or '
+                     '--recompress')
+    main(arguments)
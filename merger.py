@@ -1,5 +1,8 @@
 #!/usr/bin/env python
+import io
+import re
 import sys
+from contextlib import contextmanager
 from glob import glob
 from accessoryFunctions.accessoryFunctions import *
 __author__ = 'adamkoziol'
@@ -25,127 +28,2454 @@ def relativesymlink(src_file, dest_file):
             raise
 
 
-class Merger(object):
+# Size of the buffer used when the kernel cannot copy the data itself
+BUFFERSIZE = 8 * 1024 * 1024
+# Kernel copy mechanisms that have not (yet) failed as unsupported on this system. Once a mechanism is rejected with
+# one of the errnos below, it is removed, and every subsequent copy goes straight to the next mechanism
+KERNELCOPY = [method for method in ['copy_file_range', 'sendfile'] if hasattr(os, method)]
+UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
 
-    def idseek(self):
+
+def copyrange(source, destination, size):
+    """
+    Append :size bytes from the current position of the source file descriptor to the destination file descriptor.
+    Use os.copy_file_range or os.sendfile if the kernel supports them, as the data then never enters user space.
+    Otherwise, fall back to reading into, and writing from, a single large reusable buffer
+    :param source: file descriptor of the file to read
+    :param destination: file descriptor of the file to which the data are appended
+    :param size: number of bytes to copy
+    :return: the number of bytes copied
+    """
+    copied = 0
+    for method in list(KERNELCOPY):
+        try:
+            while copied < size:
+                # Copy up to 1 GB per system call
+                count = min(size - copied, 1 << 30)
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(source, destination, count)
+                else:
+                    # sendfile does not update the position of the source when an offset is supplied
+                    offset = os.lseek(source, 0, os.SEEK_CUR)
+                    sent = os.sendfile(destination, source, offset, count)
+                    os.lseek(source, offset + sent, os.SEEK_SET)
+                # A return value of zero means that the end of the source has been reached
+                if not sent:
+                    return copied
+                copied += sent
+            return copied
+        except OSError as exception:
+            # Only an unsupported mechanism is an excuse to try the next one. Nothing can have been copied in that case
+            if exception.errno not in UNSUPPORTED or copied:
+                raise
+            try:
+                KERNELCOPY.remove(method)
+            except ValueError:
+                pass
+    # Fall back to copying through a single reusable buffer
+    buffer = bytearray(min(BUFFERSIZE, max(size, 1)))
+    view = memoryview(buffer)
+    while copied < size:
+        read = os.readv(source, [view[:min(len(buffer), size - copied)]])
+        if not read:
+            break
+        written = 0
+        while written < read:
+            written += os.write(destination, view[written:read])
+        copied += read
+    return copied
+
+
+def concatenate(inputfiles, outputfile, statistics=None):
+    """
+    Concatenate the input files into the output file. As gzip files may consist of multiple members, appending the
+    compressed files produces a valid gzip file of the merged reads without decompressing anything
+    :param inputfiles: list of the names and paths of the files to concatenate
+    :param outputfile: name and path of the concatenated file
+    :param statistics: optional ReadStatistics object to update with the reads as they are copied. The data must then
+    pass through user space, so the kernel copy mechanisms are not used
+    :return: the number of bytes written, and the number of seconds the concatenation took
+    """
+    from time import time
+    start = time()
+    written = 0
+    with open(outputfile, 'wb') as output:
+        for inputfile in inputfiles:
+            with open(inputfile, 'rb') as source:
+                if statistics is None:
+                    written += copyrange(source.fileno(), output.fileno(), os.fstat(source.fileno()).st_size)
+                    continue
+                stream = DecompressionStream(inputfile)
+                for data in iter(lambda: source.read(BUFFERSIZE), b''):
+                    output.write(data)
+                    written += len(data)
+                    statistics.update(stream.decompress(data))
+                stream.close()
+    return written, time() - start
+
+
+# Maximum number of uncompressed bytes in a BGZF block. Leaves room for incompressible data to fit in the 64 KB block
+BGZFBLOCK = 65280
+# The empty block that marks the end of a BGZF file
+BGZFEOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+class DecompressionStream(object):
+    """
+    Incrementally decompress the contents of a file. Gzip files with any number of members are decompressed, and
+    files that are not gzip compressed are passed through unchanged
+    """
+
+    def decompress(self, data):
+        """
+        :param data: the next chunk of the file
+        :return: the decompressed data
+        """
+        import zlib
+        if self.compressed is None:
+            self.compressed = data.startswith(b'\x1f\x8b')
+        if not self.compressed:
+            return data
+        output = [self.decompressor.decompress(data)]
+        # Start a new decompressor for each subsequent gzip member
+        while self.decompressor.eof and self.decompressor.unused_data:
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(31)
+            output.append(self.decompressor.decompress(data))
+        return b''.join(output)
+
+    def close(self):
+        """Ensure that the last gzip member was complete"""
+        if self.compressed and not self.decompressor.eof:
+            raise IOError('{} is truncated'.format(self.name))
+
+    def __init__(self, name):
+        """
+        :param name: the name of the file, used in error messages
+        """
+        import zlib
+        self.name = name
+        self.compressed = None
+        self.decompressor = zlib.decompressobj(31)
+
+
+def decompress(inputfiles):
+    """
+    Stream the decompressed contents of the input files
+    :param inputfiles: list of the names and paths of the files
+    """
+    for inputfile in inputfiles:
+        stream = DecompressionStream(inputfile)
+        with open(inputfile, 'rb') as source:
+            for data in iter(lambda: source.read(BUFFERSIZE), b''):
+                yield stream.decompress(data)
+        stream.close()
+
+
+def verifyfile(path, mode='fast'):
+    """
+    Check the integrity of a fastq file. Files that are not gzip compressed are not checked
+    fast: check the gzip header. The block structure of BGZF files is walked completely, which finds truncated or
+    corrupt blocks. Other gzip files cannot be split into members without decompressing them, so apart from a corrupt
+    header, only small files (up to a few MB) cut short are found. Truncation of larger files is only found by full
+    full: decompress every member, which checks the CRC32 and uncompressed size in the trailer of each member
+    :param path: the name and path of the file
+    :param mode: fast or full
+    :return: string of the problem with the file, or None if no problem was found
+    """
+    import struct
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fastq:
+            header = fastq.read(18)
+            if not header.startswith(b'\x1f\x8b'):
+                return None
+            # A member has a 10 byte header, and an 8 byte trailer
+            if len(header) < 18 or size < 18:
+                return 'truncated: too short to be a gzip file'
+            if header[2] != 8:
+                return 'corrupt: unknown compression method {}'.format(header[2])
+            if mode == 'full':
+                stream = DecompressionStream(path)
+                fastq.seek(0)
+                for data in iter(lambda: fastq.read(BUFFERSIZE), b''):
+                    stream.decompress(data)
+                stream.close()
+                return None
+            # BGZF blocks have a BC extra field holding the size of the block, so the blocks can be walked
+            if header[3] & 4 and header[12:14] == b'BC':
+                offset = 0
+                while offset < size:
+                    fastq.seek(offset)
+                    block = fastq.read(18)
+                    if len(block) < 18 or not block.startswith(b'\x1f\x8b') or block[12:14] != b'BC':
+                        return 'corrupt: invalid BGZF block at offset {}'.format(offset)
+                    offset += struct.unpack('<H', block[16:18])[0] + 1
+                if offset != size:
+                    return 'truncated: the last BGZF block ends {} bytes after the end of the file'.format(offset - size)
+                return None
+            # The uncompressed size of the last member is at the end of the file. Deflate cannot compress by more
+            # than a factor of 1032, so a larger size means that the file does not end with a gzip trailer. As the
+            # size is modulo 2^32, this can only be told apart from a valid trailer for files under about 4 MB
+            fastq.seek(size - 4)
+            isize = struct.unpack('<I', fastq.read(4))[0]
+            if size < 1 << 32 and isize > 1032 * size:
+                return 'truncated: the file does not end with a valid gzip trailer'
+    except (IOError, OSError, EOFError) as exception:
+        return 'corrupt: {}'.format(exception)
+    except Exception as exception:
+        # zlib.error does not inherit from OSError
+        return 'corrupt: {}'.format(exception)
+    return None
+
+
+class ReadStatistics(object):
+    """
+    Read count, base count and composition, length distribution, and mean quality of a stream of fastq data. Each
+    chunk of data is processed with vectorised NumPy operations over the raw bytes, rather than line by line
+    """
+
+    def update(self, data):
+        """
+        Add the complete records in a chunk of decompressed fastq data. Any incomplete record at the end of the chunk
+        is kept, and completed by the next chunk
+        :param data: the next chunk of decompressed fastq data
+        """
+        from time import time
+        numpy = self.numpy
+        start = time()
+        buffer = self.leftover + data if self.leftover else data
+        array = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(array == 10)
+        # Only process complete four line records
+        lines = len(newlines) // 4 * 4
+        if not lines:
+            self.leftover = bytes(buffer)
+            self.seconds += time() - start
+            return
+        end = newlines[lines - 1] + 1
+        self.leftover = bytes(buffer[end:])
+        array = array[:end]
+        ends = newlines[:lines]
+        starts = numpy.empty(lines, dtype=numpy.int64)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        # Don't count the carriage returns of files with Windows line endings
+        ends = ends - ((array[ends - 1] == 13) & (ends > starts))
+        sequencestarts, sequenceends = starts[1::4], ends[1::4]
+        qualitystarts, qualityends = starts[3::4], ends[3::4]
+        lengths = sequenceends - sequencestarts
+        self.reads += len(lengths)
+        # Update the length distribution
+        counts = numpy.bincount(lengths)
+        if len(counts) > len(self.lengths):
+            counts[:len(self.lengths)] += self.lengths
+            self.lengths = counts
+        else:
+            self.lengths[:len(counts)] += counts
+        # Mark the bytes of the sequence and quality lines by adding one at the start of each line, and subtracting one
+        # at the end, before taking the cumulative sum
+        marker = numpy.zeros(end + 1, dtype=numpy.int8)
+        marker[sequencestarts] += 1
+        marker[sequenceends] -= 1
+        self.composition += numpy.bincount(array[numpy.cumsum(marker[:end], dtype=numpy.int8).view(bool)],
+                                           minlength=256)
+        marker[:] = 0
+        marker[qualitystarts] += 1
+        marker[qualityends] -= 1
+        quality = array[numpy.cumsum(marker[:end], dtype=numpy.int8).view(bool)]
+        self.quality += int(quality.sum(dtype=numpy.int64)) - 33 * len(quality)
+        self.qualities += len(quality)
+        self.seconds += time() - start
+
+    def summary(self):
+        """
+        :return: dictionary of the statistics
+        """
+        bases = int(self.lengths.dot(self.numpy.arange(len(self.lengths))))
+        observed = self.numpy.flatnonzero(self.lengths)
+        composition = {base: int(self.composition[ord(base)] + self.composition[ord(base.lower())])
+                       for base in 'ACGTN'}
+        return {
+            'reads': self.reads,
+            'bases': bases,
+            'composition': composition,
+            'gc': (composition['G'] + composition['C']) / bases if bases else 0,
+            'minlength': int(observed[0]) if len(observed) else 0,
+            'maxlength': int(observed[-1]) if len(observed) else 0,
+            'meanlength': bases / self.reads if self.reads else 0,
+            'lengths': {int(length): int(self.lengths[length]) for length in observed},
+            'meanquality': self.quality / self.qualities if self.qualities else 0,
+            'seconds': self.seconds
+        }
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+        self.leftover = b''
+        self.reads = 0
+        self.lengths = numpy.zeros(0, dtype=numpy.int64)
+        self.composition = numpy.zeros(256, dtype=numpy.int64)
+        self.quality = 0
+        self.qualities = 0
+        # Time spent calculating the statistics, so that the overhead can be compared to the time spent copying
+        self.seconds = 0
+
+
+def bgzfblock(data, level):
+    """
+    Compress data into a single BGZF block: a gzip member with the BC extra field holding the size of the block
+    :param data: up to BGZFBLOCK bytes of uncompressed data
+    :param level: the compression level
+    :return: the compressed block
+    """
+    import struct
+    import zlib
+    # zlib releases the GIL while compressing, so blocks are compressed in parallel by a pool of threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    # Header (with the total block size minus one in the BC field), deflated data, CRC32, and uncompressed size
+    return struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25) + \
+        deflated + struct.pack('<2I', zlib.crc32(data), len(data))
+
+
+def recompress(inputfiles, outputfile, pool, indexfile=None, level=6, depth=None, statistics=None):
+    """
+    Decompress the input files, and recompress their contents into a single BGZF file, compressing blocks in parallel.
+    A .gzi index of the offsets of the blocks is written alongside, so that the file can be read from any block
+    :param inputfiles: list of the names and paths of the files to merge
+    :param outputfile: name and path of the BGZF file
+    :param pool: pool of threads to compress the blocks
+    :param indexfile: name and path of the .gzi index. Default is the name of the output file with .gzi appended
+    :param level: the compression level
+    :param depth: the maximum number of blocks being compressed, or waiting to be written, at the same time. Bounds the
+    memory used to a fixed number of blocks. Default is four blocks for each thread in the pool
+    :param statistics: optional ReadStatistics object to update with the reads as they are recompressed
+    :return: the number of uncompressed bytes, the number of bytes written, and the number of seconds it took
+    """
+    import struct
+    from collections import deque
+    from time import time
+    start = time()
+    depth = depth if depth else 4 * pool._max_workers
+    # The ring of blocks in flight, in the order in which they are to be written
+    ring = deque()
+    offsets = list()
+    uncompressed = 0
+    written = 0
+
+    def write(block):
+        nonlocal written
+        # Record the compressed and uncompressed offsets of every block
+        offsets.append((written, len(offsets) * BGZFBLOCK))
+        output.write(block)
+        written += len(block)
+
+    with open(outputfile, 'wb') as output:
+        pending = bytearray()
+        for data in decompress(inputfiles):
+            if statistics is not None:
+                statistics.update(data)
+            pending += data
+            uncompressed += len(data)
+            while len(pending) >= BGZFBLOCK:
+                ring.append(pool.submit(bgzfblock, bytes(pending[:BGZFBLOCK]), level))
+                del pending[:BGZFBLOCK]
+                # Wait for the oldest block once the ring is full
+                if len(ring) >= depth:
+                    write(ring.popleft().result())
+        if pending:
+            ring.append(pool.submit(bgzfblock, bytes(pending), level))
+        while ring:
+            write(ring.popleft().result())
+        output.write(BGZFEOF)
+        written += len(BGZFEOF)
+    # The index lists the offsets of every block except the first, preceded by the number of entries
+    with open(indexfile if indexfile else '{}.gzi'.format(outputfile), 'wb') as index:
+        index.write(struct.pack('<Q', len(offsets[1:])))
+        for offset in offsets[1:]:
+            index.write(struct.pack('<2Q', *offset))
+    return uncompressed, written, time() - start
+
+
+def fastqreads(inputfiles):
+    """
+    Stream the four line records of the input files, without holding more than a chunk of the files in memory
+    :param inputfiles: list of the names and paths of the files
+    :return: generator of each record, including its newlines
+    """
+    pending = b''
+    for data in decompress(inputfiles):
+        lines = (pending + data).split(b'\n')
+        # Keep the incomplete last line, and any lines of an incomplete record, for the next chunk
+        complete = (len(lines) - 1) // 4 * 4
+        for line in range(0, complete, 4):
+            yield b'\n'.join(lines[line:line + 4]) + b'\n'
+        pending = b'\n'.join(lines[complete:])
+    if pending.strip():
+        yield pending.rstrip(b'\n') + b'\n'
+
+
+def countreads(inputfiles, bases=False):
+    """
+    :param inputfiles: list of the names and paths of fastq files
+    :param bases: boolean of whether the bases should be counted as well as the reads. This takes a vectorised pass
+    over every record rather than only counting newlines
+    :return: the number of reads, and the number of bases (or None if they were not counted)
+    """
+    if bases:
+        statistics = ReadStatistics()
+        for data in decompress(inputfiles):
+            statistics.update(data)
+        summary = statistics.summary()
+        return summary['reads'], summary['bases']
+    lines = 0
+    last = b'\n'
+    for data in decompress(inputfiles):
+        if data:
+            lines += data.count(b'\n')
+            last = data[-1:]
+    # Allow for a file that does not end with a newline
+    return (lines + (last != b'\n') + 3) // 4, None
+
+
+def subsample(forwardfiles, reversefiles, forwardoutput, reverseoutput, seed, pairs=None, bases=None, level=6,
+              statistics=(None, None)):
+    """
+    Merge a reproducible random subsample of the read pairs of a sample. The first pass counts the pairs (and the
+    bases), and the second streams the forward and reverse reads in step, selecting each pair with the probability
+    that leaves exactly the target number to be selected from the pairs that remain (selection sampling). Only the
+    current pair is held in memory, and the same seed and inputs always select the same pairs
+    :param forwardfiles: list of the names and paths of the forward fastq files
+    :param reversefiles: list of the names and paths of the reverse fastq files, in the same order as the forward files
+    :param forwardoutput: name and path of the gzip compressed subsample of the forward reads
+    :param reverseoutput: name and path of the gzip compressed subsample of the reverse reads
+    :param seed: the seed of the random selection
+    :param pairs: the target number of read pairs
+    :param bases: the target number of bases in the forward and reverse reads together e.g. genome size x coverage
+    :param level: the compression level of the subsample
+    :param statistics: optional ReadStatistics objects to update with the selected forward and reverse reads
+    :return: dictionary of the number of pairs and bases in the inputs (bases are only counted for a base target), the
+    number of pairs selected, the fraction of the pairs selected, and the number of seconds it took
+    """
+    import gzip
+    import math
+    from random import Random
+    from time import time
+    start = time()
+    forwardreads, forwardbases = countreads(forwardfiles, bases is not None)
+    reversereads, reversebases = countreads(reversefiles, bases is not None)
+    if forwardreads != reversereads:
+        raise ValueError('Cannot subsample unpaired reads: {} forward reads, but {} reverse reads'
+                         .format(forwardreads, reversereads))
+    total = forwardreads
+    totalbases = forwardbases + reversebases if bases is not None else None
+    # The number of pairs to select. A base target is converted using the mean number of bases in a pair
+    if bases is not None:
+        target = int(math.ceil(total * bases / totalbases)) if totalbases else 0
+    else:
+        target = pairs
+    # Samples already below the target are concatenated unchanged
+    if target >= total:
+        concatenate(forwardfiles, forwardoutput, statistics[0])
+        concatenate(reversefiles, reverseoutput, statistics[1])
+        return {'pairs': total, 'bases': totalbases, 'selected': total, 'ratio': 1 if total else 0,
+                'seconds': time() - start}
+    random = Random(seed)
+    remaining = target
+    buffers = (bytearray(), bytearray())
+    # The name and modification time in the gzip headers are left empty, so that the same subsample is always identical
+    with open(forwardoutput, 'wb') as forwardfile, open(reverseoutput, 'wb') as reversefile, \
+            gzip.GzipFile('', 'wb', fileobj=forwardfile, compresslevel=level, mtime=0) as forward, \
+            gzip.GzipFile('', 'wb', fileobj=reversefile, compresslevel=level, mtime=0) as reverse:
+        outputs = (forward, reverse)
+
+        def flush():
+            for output, buffer, readstatistics in zip(outputs, buffers, statistics):
+                output.write(buffer)
+                if readstatistics is not None:
+                    readstatistics.update(bytes(buffer))
+                del buffer[:]
+
+        for seen, pair in enumerate(zip(fastqreads(forwardfiles), fastqreads(reversefiles))):
+            if remaining == 0:
+                break
+            # Select this pair with probability (pairs still to select) / (pairs not yet seen)
+            if random.random() * (total - seen) < remaining:
+                buffers[0].extend(pair[0])
+                buffers[1].extend(pair[1])
+                remaining -= 1
+                if len(buffers[0]) >= BUFFERSIZE:
+                    flush()
+        flush()
+    return {'pairs': total, 'bases': totalbases, 'selected': target - remaining,
+            'ratio': (target - remaining) / total if total else 0, 'seconds': time() - start}
+
+
+# The FICLONE ioctl, which makes the destination file share the extents of the source file (a reflink)
+FICLONE = 0x40049409
+
+
+def deliver(source, destination):
+    """
+    Create an independent copy of a file as cheaply as possible. Try a reflink first, then a hardlink if the source
+    and destination are on the same filesystem, and finally a copy with copy_file_range. Merged files are only ever
+    replaced by renaming a new file into place, never modified, so a hardlinked delivery is not changed by later merges
+    :param source: the name and path of the file
+    :param destination: the name and path of the copy. An existing file is replaced
+    :return: the method used (reflink, hardlink, copy, or existing if the destination is already a hardlink to the
+    source), and the number of seconds it took
+    """
+    import fcntl
+    from time import time
+    start = time()
+    # Renaming a hardlink over another link to the same file does nothing, and would leave the temporary link behind
+    try:
+        if os.path.samefile(source, destination):
+            return 'existing', time() - start
+    except FileNotFoundError:
+        pass
+    temporary = temporaryfile(destination)
+    try:
+        try:
+            with open(source, 'rb') as original, open(temporary, 'wb') as clone:
+                fcntl.ioctl(clone.fileno(), FICLONE, original.fileno())
+            method = 'reflink'
+        except OSError as exception:
+            # Anything other than the filesystems not supporting reflinks (between them) is a real error
+            if exception.errno not in UNSUPPORTED | {errno.ENOTTY, errno.EPERM}:
+                raise
+            os.remove(temporary)
+            if os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(destination))).st_dev:
+                os.link(source, temporary)
+                method = 'hardlink'
+            else:
+                concatenate([source], temporary)
+                method = 'copy'
+        os.replace(temporary, destination)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+    return method, time() - start
+
+
+class MergeCache(object):
+    """
+    Content-addressed cache of merged files, shared between requests. Each merged file is stored under a key made from
+    the identities (real path, size, and modification time) of its sorted inputs, and the format of the merged file.
+    Files are delivered to and from the cache by reflink or hardlink where possible, so cached merges take no extra
+    space. The least recently used files are evicted once the cache exceeds its size limit. A lock file serialises
+    access between concurrent runs: fetches hold a shared lock, while stores and evictions hold an exclusive lock
+    """
+
+    @staticmethod
+    def key(inputs, variant):
+        """
+        :param inputs: list of the path, size, and modification time of each of the input files
+        :param variant: string describing how the inputs are merged e.g. the format of the merged file
+        :return: the cache key of the merged file
+        """
+        import hashlib
+        import json
+        identities = sorted((os.path.realpath(x['path']), x['size'], x['mtime']) for x in inputs)
+        return hashlib.sha256(json.dumps([identities, variant]).encode()).hexdigest()
+
+    def entry(self, key):
+        """
+        :param key: the cache key
+        :return: the name and path of the cached file
+        """
+        return os.path.join(self.path, key[:2], '{}.fastq.gz'.format(key))
+
+    @contextmanager
+    def locked(self, exclusive):
+        """
+        Hold the lock of the cache
+        :param exclusive: boolean of whether an exclusive, rather than a shared, lock is required
+        """
+        import fcntl
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def used(entry):
+        """
+        Mark an entry as recently used. The cached file is a hardlink of the merged files delivered from it, whose
+        modification times are checked against their manifests, so the time is kept on a separate .used stamp
+        :param entry: the name and path of the cached file
+        """
+        with open('{}.used'.format(entry), 'a'):
+            pass
+        os.utime('{}.used'.format(entry))
+
+    def fetch(self, key, destination, sidecars=(), metadata=()):
+        """
+        Deliver a cached file (and any of its sidecar files) to the destination if it is in the cache
+        :param key: the cache key
+        :param destination: the name and path to which the cached file is delivered
+        :param sidecars: the suffixes of any files stored alongside the cached file that must also be present
+        :param metadata: the names of any metadata (e.g. read statistics) the entry must have to be used
+        :return: dictionary of the metadata stored with the entry, or None if the file is not in the cache
+        """
+        import json
+        entry = self.entry(key)
+        with self.locked(False):
+            if not all(os.path.isfile(entry + suffix) for suffix in ('',) + tuple(sidecars)):
+                return None
+            try:
+                with open('{}.json'.format(entry)) as stored:
+                    information = json.load(stored)
+            except (IOError, OSError, ValueError):
+                information = dict()
+            if not all(name in information for name in metadata):
+                return None
+            for suffix in ('',) + tuple(sidecars):
+                deliver(entry + suffix, destination + suffix)
+            self.used(entry)
+        return information
+
+    def store(self, key, source, sidecars=(), metadata=None):
+        """
+        Add a merged file (and any of its sidecar files) to the cache, and evict the least recently used files if the
+        cache is now too large
+        :param key: the cache key
+        :param source: the name and path of the merged file
+        :param sidecars: the suffixes of any files stored alongside the merged file
+        :param metadata: optional dictionary of information (e.g. read statistics) to store with the entry
+        """
+        import json
+        entry = self.entry(key)
+        make_path(os.path.dirname(entry))
+        # Stage the files in the cache before taking the lock, as delivering them from another filesystem copies them
+        staged = temporaryfile(entry)
+        suffixes = [suffix for suffix in sidecars if os.path.isfile(source + suffix)]
+        try:
+            for suffix in suffixes:
+                deliver(source + suffix, staged + suffix)
+            if metadata:
+                with open('{}.json'.format(staged), 'w') as stored:
+                    json.dump(metadata, stored)
+                suffixes.append('.json')
+            deliver(source, staged)
+            with self.locked(True):
+                # Move the sidecar files and metadata into place first, so that an entry is never visible without them
+                for suffix in suffixes + ['']:
+                    os.replace(staged + suffix, entry + suffix)
+                self.used(entry)
+                self.evict()
+        finally:
+            # Renaming a hardlink over another link to the same file does nothing, and leaves the staged link behind
+            for suffix in suffixes + ['']:
+                if os.path.isfile(staged + suffix):
+                    os.remove(staged + suffix)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within its size limit. Requires the lock"""
+        if not self.maxsize:
+            return
+        entries = list()
+        for directory in os.scandir(self.path):
+            if directory.is_dir():
+                for cached in os.scandir(directory.path):
+                    if cached.name.endswith('.fastq.gz'):
+                        stat = cached.stat()
+                        sidecars = glob('{}.*'.format(cached.path))
+                        # Entries are ordered by when they were last stored or fetched
+                        used = '{}.used'.format(cached.path)
+                        entries.append((os.path.getmtime(used) if used in sidecars else stat.st_mtime, cached.path,
+                                        stat.st_size + sum(os.path.getsize(sidecar) for sidecar in sidecars),
+                                        sidecars))
+        total = sum(entry[2] for entry in entries)
+        for _, path, size, sidecars in sorted(entries):
+            if total <= self.maxsize:
+                break
+            for cached in [path] + sidecars:
+                os.remove(cached)
+            total -= size
+
+    def __init__(self, path, maxsize=None):
+        """
+        :param path: the directory of the cache
+        :param maxsize: the maximum size of the cache in bytes. The cache is unlimited if this is not provided
+        """
+        self.path = path
+        self.maxsize = maxsize
+        make_path(path)
+
+
+def throughput(size, seconds):
+    """
+    :param size: number of bytes processed
+    :param seconds: time taken to process the bytes
+    :return: string of the throughput in MB/s
+    """
+    return '{:.1f} MB/s'.format(size / 1048576 / seconds if seconds else 0)
+
+
+# Regular expression to split fastq file names such as 2014-SEQ-0001_S1_L001_R1_001.fastq.gz or 2014-SEQ-0001_1.fastq
+# into the sample, sample number, lane, read direction, and chunk fields
+FASTQNAME = re.compile(r'^(?P<sample>.+?)(?:_S(?P<number>\d+))?(?:_L(?P<lane>\d+))?_R?(?P<read>[12])'
+                       r'(?:_(?P<chunk>\d+))?\.f(?:ast)?q')
+
+
+def temporaryfile(path):
+    """
+    :param path: the name and path of a file to be created
+    :return: the name and path of a hidden temporary file, in the same directory, to write the file to before renaming
+    it into place. The name is unique to this host and process
+    """
+    import socket
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.{}.{}.partial'.format(name, socket.gethostname(), os.getpid()))
+
+
+def md5sum(path):
+    """
+    :param path: the name and path of the file
+    :return: the hexadecimal MD5 checksum of the file
+    """
+    import hashlib
+    checksum = hashlib.md5()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(BUFFERSIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def readmanifest(manifestfile):
+    """
+    :param manifestfile: the name and path of the manifest of a merged sample
+    :return: dictionary of the manifest entry of each merged file (R1/R2). Empty if there is no usable manifest
+    """
+    import json
+    try:
+        with open(manifestfile) as manifest:
+            return json.load(manifest)['files']
+    except (IOError, OSError, ValueError, KeyError):
+        return dict()
+
+
+def writemanifest(manifestfile, name, files):
+    """
+    Atomically write the manifest of a merged sample
+    :param manifestfile: the name and path of the manifest
+    :param name: the name of the sample
+    :param files: dictionary of the output file, its size and modification time, and the path, size, and modification
+    time of each of its input files for each merged file (R1/R2)
+    """
+    import json
+    temporary = temporaryfile(manifestfile)
+    with open(temporary, 'w') as manifest:
+        json.dump({'sample': name, 'files': files}, manifest, indent=4, sort_keys=True)
+    os.replace(temporary, manifestfile)
+
+
+def writestatisticstable(tablefile, samples):
+    """
+    Write a table of the read statistics of the merged files of every sample
+    :param tablefile: the name and path of the table
+    :param samples: list of the sample records
+    """
+    columns = ['reads', 'bases', 'minlength', 'maxlength', 'meanlength', 'meanquality', 'gc']
+    with open(tablefile, 'w') as table:
+        table.write('\t'.join(['sample', 'read'] + columns + ['paired']) + '\n')
+        for sample in samples:
+            for read in ['R1', 'R2']:
+                statistics = sample.general.statistics.get(read)
+                if statistics:
+                    table.write('\t'.join([str(sample.name), read] + [str(statistics[x]) for x in columns] +
+                                          [str(sample.general.statistics.get('R1', {}).get('reads') ==
+                                               sample.general.statistics.get('R2', {}).get('reads'))]) + '\n')
+
+
+def writesubsamplingtable(tablefile, samples, genomesize=None):
+    """
+    Write a table of the fraction of the read pairs of every sample kept by subsampling
+    :param tablefile: the name and path of the table
+    :param samples: list of the sample records
+    :param genomesize: optional genome size, used to estimate the coverage before and after subsampling
+    """
+    with open(tablefile, 'w') as table:
+        table.write('\t'.join(['sample', 'pairs', 'selected', 'ratio', 'coverage', 'subsampledcoverage']) + '\n')
+        for sample in samples:
+            report = sample.general.manifest.get('R1', {}).get('subsample')
+            if not report:
+                continue
+            coverage = report['bases'] / genomesize if genomesize and report['bases'] is not None else None
+            table.write('\t'.join([str(sample.name), str(report['pairs']), str(report['selected']),
+                                   '{:.6f}'.format(report['ratio']),
+                                   '{:.1f}'.format(coverage) if coverage is not None else '',
+                                   '{:.1f}'.format(coverage * report['ratio']) if coverage is not None else '']) +
+                        '\n')
+
+
+class SeqIDRecord(object):
+    """A sample from the seq ID file, and the seq IDs to merge for it"""
+    # A fixed set of attributes keeps the records of large sheets small. :general and :commands are populated as the
+    # sample is processed
+    __slots__ = ('name', 'merge', 'attributes', 'general', 'commands')
+
+    def __init__(self, name, merge, attributes=None):
+        """
+        :param name: the name of the merged sample
+        :param merge: list of the seq IDs to merge
+        :param attributes: optional dictionary of any other columns in the seq ID file
+        """
+        self.name = name
+        self.merge = merge
+        self.attributes = attributes if attributes else dict()
+        self.general = None
+        self.commands = None
+
+
+def readseqids(idfile, delimiter):
+    """
+    Read the seq ID file one line at a time, and yield a record for each sample. Delimited text files either have a
+    header with 'Name' and 'Merge' columns (separated by tabs, or commas for .csv files), or simply contain the seq IDs
+    to merge on each line, in which case the sample is named after the first seq ID. pandas is only imported for Excel
+    workbooks
+    :param idfile: the name and path of the seq ID file
+    :param delimiter: the delimiter between the seq IDs to merge
+    """
+    if os.path.splitext(idfile)[1].lower() in ['.xls', '.xlsx', '.xlsm']:
         import pandas
-        nesteddictionary = dict()
-        # Create a list of all the lines in the file: open(self.idfile).readlines()
-        # Create a lambda function
-        # Map the list to the lambda function and split the list based on the delimiter: x.split(self.delimiter)
-        # List comprehension of individual seq IDs without whitespace: [x.rstrip() for x in ...]
-        # self.seqids = map(lambda x: [x.rstrip() for x in x.split(self.delimiter)], open(self.idfile).readlines())
-        dictionary = pandas.read_excel(self.idfile).to_dict()
-        # Iterate through the dictionary - each header from the excel file
-        for header in dictionary:
-            # Sample is the primary key, and value is the value of the cell for that primary key + header combination
-            for sample, value in dictionary[header].items():
-                # Update the dictionary with the new data
+        for row, values in enumerate(pandas.read_excel(idfile).to_dict('records')):
+            # Use the header (in lowercase, and spaces removed) as the name of each column
+            columns = {str(header).replace(' ', '').lower(): str(value) for header, value in values.items()}
+            # Samples without a name column are named after their row in the file
+            name = columns.pop('name', row)
+            yield SeqIDRecord(name, [x.strip() for x in columns.pop('merge').split(delimiter) if x.strip()], columns)
+        return
+    with open(idfile) as lines:
+        headers = None
+        for line in lines:
+            if not line.strip():
+                continue
+            # Determine whether the first line is a header
+            if headers is None:
+                separator = ',' if idfile.lower().endswith('.csv') and '\t' not in line else '\t'
+                fields = [x.replace(' ', '').lower() for x in line.rstrip('\r\n').split(separator)]
+                headers = fields if 'name' in fields and 'merge' in fields else list()
+                if headers:
+                    continue
+            if headers:
+                columns = dict(zip(headers, line.rstrip('\r\n').split(separator)))
+                name = columns.pop('name').strip()
+                yield SeqIDRecord(name, [x.strip() for x in columns.pop('merge').split(delimiter) if x.strip()],
+                                  columns)
+            else:
+                seqids = [x.strip() for x in line.split(delimiter) if x.strip()]
+                yield SeqIDRecord(seqids[0], seqids)
+
+
+class FastqIndex(object):
+    """
+    Index of the fastq files in a directory, built from a single os.scandir pass. The names are kept in a sorted list,
+    so that all the files starting with a seq ID are found with a binary search rather than a glob of the directory
+    """
+
+    def find(self, seqid):
+        """
+        Find the files in the index with the seq ID as a prefix - equivalent to glob('{path}{seqid}*fastq*')
+        :param seqid: the seq ID to find
+        :return: list of the records of the matching files
+        """
+        from bisect import bisect_left
+        records = list()
+        position = bisect_left(self.names, seqid)
+        # Sorted names sharing the prefix are adjacent, so stop at the first name without it
+        while position < len(self.names) and self.names[position].startswith(seqid):
+            name = self.names[position]
+            # The 'fastq' must follow the seq ID, as with the glob
+            if 'fastq' in name[len(seqid):]:
+                records.append(self.refresh(self.records[name]))
+            position += 1
+        return records
+
+    def refresh(self, record):
+        """
+        Update the size and modification time of a record loaded from a persisted index. Rewriting a file in place does
+        not change the modification time of the directory, so only the names in a persisted index can be relied on
+        :param record: the record of a fastq file
+        :return: the record
+        """
+        if record['name'] in self.unchecked:
+            stat = os.stat(record['path'])
+            record.update({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'device': stat.st_dev})
+            self.unchecked.discard(record['name'])
+        return record
+
+    @staticmethod
+    def parse(name):
+        """
+        Parse the name of a fastq file into its fields
+        :param name: the name of the fastq file
+        :return: dictionary of the sample, number, lane, read, and chunk fields. Fields missing from the name are None
+        """
+        match = FASTQNAME.match(name)
+        if match:
+            return match.groupdict()
+        # Use the old substring tests to determine the read direction of names that don't fit the expected format
+        fields = dict.fromkeys(['sample', 'number', 'lane', 'read', 'chunk'])
+        if '_R1_' in name or '_1_' in name or '_1.' in name:
+            fields['read'] = '1'
+        elif '_R2_' in name or '_2_' in name or '_2.' in name:
+            fields['read'] = '2'
+        return fields
+
+    def scan(self):
+        """Read the directory once, and create a record for every fastq file"""
+        self.records = dict()
+        for entry in os.scandir(self.path):
+            # Hidden files are not matched by glob, so ignore them here as well
+            if 'fastq' in entry.name and not entry.name.startswith('.') and entry.is_file():
+                stat = entry.stat()
+                record = self.parse(entry.name)
+                record.update({'name': entry.name, 'path': os.path.join(self.path, entry.name),
+                               'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'device': stat.st_dev})
+                self.records[entry.name] = record
+
+    def load(self):
+        """
+        Load a persisted index
+        :return: boolean of whether the persisted index could be used
+        """
+        import json
+        try:
+            with open(self.indexfile) as index:
+                stored = json.load(index)
+        except (IOError, OSError, ValueError):
+            return False
+        # Only reuse the index if no files have been added to, removed from, or renamed in the directory since
+        if stored.get('mtime') != os.stat(self.path).st_mtime_ns:
+            return False
+        self.records = stored['records']
+        # The path depends on how the directory was specified, and the device on the host, so neither is stored
+        for name, record in self.records.items():
+            record.update({'path': os.path.join(self.path, name), 'device': None})
+        # The files are only checked once they are found, so that the rest of the directory is never read
+        self.unchecked = set(self.records)
+        return True
+
+    def save(self):
+        """Persist the index next to the data"""
+        import json
+        exists = os.path.isfile(self.indexfile)
+        records = {name: {field: value for field, value in record.items() if field not in ['path', 'device']}
+                   for name, record in self.records.items()}
+        # Write a new index file to a temporary file and rename it into place. This changes the modification time of
+        # the directory, so the file is rewritten in place (which does not) once the new modification time is known
+        if not exists:
+            temporary = '{}.{}'.format(self.indexfile, os.getpid())
+            with open(temporary, 'w') as index:
+                json.dump({'mtime': None, 'records': records}, index)
+            os.replace(temporary, self.indexfile)
+        with open(self.indexfile, 'w') as index:
+            json.dump({'mtime': os.stat(self.path).st_mtime_ns, 'records': records}, index)
+
+    def __init__(self, path, persist=False):
+        """
+        :param path: the directory containing the fastq files
+        :param persist: boolean of whether to reuse an index persisted in the directory. The index is persisted by
+        save, which is only called once the run has finished writing to the directory
+        """
+        # The paths of the records end up in the manifests, so they must not depend on how the directory was specified
+        self.path = os.path.abspath(path)
+        self.indexfile = os.path.join(path, '.fastqindex.json')
+        self.records = dict()
+        # The names of the records loaded from a persisted index whose files have not been checked yet
+        self.unchecked = set()
+        if not (persist and self.load()):
+            self.scan()
+        self.names = sorted(self.records)
+
+
+class DeviceLimit(object):
+    """
+    Limit on the number of jobs reading from, or writing to, a single filesystem. When auto-tuning, the limit starts
+    at one, and is moved up or down by one after each measurement window, depending on whether the throughput of the
+    filesystem improved with the last move
+    """
+
+    def record(self, size):
+        """
+        Add the bytes of a finished job to the current measurement window, and adjust the limit if auto-tuning
+        :param size: the number of bytes processed by the job
+        """
+        from time import time
+        self.bytes += size
+        self.finished += 1
+        elapsed = time() - self.windowstart
+        # Only measure once the window is long enough, and has seen at least as many jobs as are allowed to run
+        if not self.autotune or elapsed < self.window or self.finished < self.limit:
+            return
+        rate = self.bytes / elapsed
+        # Keep moving in the same direction while throughput improves, and turn around once it stops improving
+        if rate < self.rate * 1.05:
+            self.direction = -self.direction
+        self.limit = max(1, min(self.maximum, self.limit + self.direction))
+        self.rate = rate
+        self.bytes = 0
+        self.finished = 0
+        self.windowstart = time()
+
+    def __init__(self, limit, autotune=False, window=5):
+        """
+        :param limit: the maximum number of jobs allowed to use the filesystem at the same time
+        :param autotune: boolean of whether to tune the limit (up to :limit) from the observed throughput
+        :param window: minimum number of seconds over which the throughput is measured when auto-tuning
+        """
+        from time import time
+        self.maximum = limit
+        self.autotune = autotune
+        self.limit = 1 if autotune else limit
+        self.window = window
+        self.active = 0
+        self.bytes = 0
+        self.finished = 0
+        self.rate = 0
+        self.direction = 1
+        self.windowstart = time()
+
+
+class Scheduler(object):
+    """
+    Runs I/O-bound jobs largest first, with the number of concurrent jobs capped both in total and for each of the
+    source and destination filesystems (identified by st_dev) the jobs use
+    """
+
+    def available(self, job):
+        """
+        :param job: the job to check
+        :return: boolean of whether the job can be started without exceeding any of the limits
+        """
+        return all(self.limits[device].active < self.limits[device].limit for device in job.devices)
+
+    def register(self, jobs):
+        """
+        Create a limit for every filesystem used by the jobs. Filesystems used as both source and destination get the
+        lower limit
+        :param jobs: list of the jobs
+        """
+        for job in jobs:
+            for device in job.devices:
+                limit = self.destinationjobs if device == job.destination else self.sourcejobs
+                if device not in self.limits or self.limits[device].maximum > limit:
+                    self.limits[device] = DeviceLimit(limit, self.autotune)
+
+    async def run(self, jobs, worker, refill=None):
+        """
+        Run the jobs
+        :param jobs: list of the jobs to run. Each job must have a size (bytes), and a set of devices it uses
+        :param worker: coroutine function to run each job. Returns the number of bytes processed
+        :param refill: optional function to get more jobs (e.g. from a queue) as jobs finish. It is called with the
+        number of jobs that could be started, and returns a list of jobs. The jobs are run until none are left, and
+        none are returned
+        :return: dictionary of the result, or the exception raised, for each job
+        """
+        import asyncio
+        self.register(jobs)
+        # Longest processing time first, so that no large job is left running alone at the end of the batch
+        pending = sorted(jobs, key=lambda x: x.size, reverse=True)
+        running = dict()
+        results = dict()
+        try:
+            while True:
+                if refill and len(running) + len(pending) < self.threads:
+                    added = refill(self.threads - len(running) - len(pending))
+                    self.register(added)
+                    pending = sorted(pending + added, key=lambda x: x.size, reverse=True)
+                if not (pending or running):
+                    break
+                # Start every pending job that fits within the limits, largest first
+                waiting = list()
+                for job in pending:
+                    if len(running) < self.threads and self.available(job):
+                        for device in job.devices:
+                            self.limits[device].active += 1
+                        running[asyncio.ensure_future(worker(job))] = job
+                    else:
+                        waiting.append(job)
+                pending = waiting
+                # Look for more jobs every second while there is room for them
+                done, _ = await asyncio.wait(running, timeout=1 if refill else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job = running.pop(task)
+                    for device in job.devices:
+                        self.limits[device].active -= 1
+                    if task.exception():
+                        results[id(job)] = task.exception()
+                    else:
+                        results[id(job)] = task.result()
+                        for device in job.devices:
+                            self.limits[device].record(task.result() or 0)
+        finally:
+            # Cancel, and wait for, any jobs still running if the scheduler itself is cancelled
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+        return results
+
+    def __init__(self, threads, sourcejobs, destinationjobs, autotune=False):
+        """
+        :param threads: the maximum number of jobs to run at the same time
+        :param sourcejobs: the maximum number of jobs to read from a single filesystem at the same time
+        :param destinationjobs: the maximum number of jobs to write to a single filesystem at the same time
+        :param autotune: boolean of whether to tune the filesystem limits from the observed throughput
+        """
+        self.threads = threads
+        self.sourcejobs = sourcejobs
+        self.destinationjobs = destinationjobs
+        self.autotune = autotune
+        self.limits = dict()
+
+
+class Metrics(object):
+    """
+    Timing spans, counters, and per-job events for a run, written to a JSON lines file as they happen. Each event is a
+    single short write, so the metrics are cheap enough to be collected for every run
+    """
+
+    def event(self, kind, **fields):
+        """
+        Record an event
+        :param kind: the type of the event e.g. span or job
+        :param fields: the fields of the event
+        """
+        from time import time
+        import json
+        if not self.metricsfile:
+            return
+        fields.update({'event': kind, 'time': time()})
+        line = json.dumps(fields, sort_keys=True) + '\n'
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+
+    @contextmanager
+    def span(self, name, **fields):
+        """
+        Time a block of code, and record it as a span
+        :param name: the name of the span
+        :param fields: any additional fields of the event
+        """
+        from time import time
+        start = time()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0) + time() - start
+            self.event('span', name=name, start=start, seconds=time() - start, **fields)
+
+    def increment(self, name, value=1):
+        """
+        Increase a counter
+        :param name: the name of the counter
+        :param value: the amount by which to increase the counter
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def close(self):
+        """Record the totals of the spans and counters, and close the metrics file"""
+        self.event('summary', spans=self.spans, counters=self.counters)
+        if self.metricsfile:
+            self.output.close()
+            self.metricsfile = None
+
+    def __init__(self, metricsfile=None):
+        """
+        :param metricsfile: the name and path of the JSON lines file. Nothing is written if this is not provided
+        """
+        from threading import Lock
+        self.metricsfile = metricsfile
+        self.output = open(metricsfile, 'a') if metricsfile else None
+        self.lock = Lock()
+        self.spans = dict()
+        self.counters = dict()
+
+
+# The arguments that determine how the merged files are created. They are sent to the workers with each task
+SPOOLARGUMENTS = ['backend', 'checksum', 'recompress', 'statistics', 'subsample', 'genomesize', 'coverage', 'seed',
+                  'cache', 'cachesize']
+
+
+class Spool(object):
+    """
+    A queue of merge tasks in a directory on storage shared by any number of hosts. Each task is a JSON file, named
+    after the run that submitted it and its position in the run. A worker claims a task by renaming it from pending/
+    to claimed/ with the name of the worker appended. Renaming is atomic, so only one worker can claim each task.
+    Workers touch the tasks they hold as a heartbeat, and tasks whose heartbeat stops (because their worker died) are
+    renamed back to pending/ for another worker. The result of each task is written to done/ for the coordinator
+    """
+
+    def pending(self, name):
+        """
+        :param name: the name of the task
+        :return: the name and path of the task file while it is waiting to be claimed
+        """
+        return os.path.join(self.path, 'pending', '{}.json'.format(name))
+
+    def claimed(self, name, worker):
+        """
+        :param name: the name of the task
+        :param worker: the name of the worker
+        :return: the name and path of the task file while it is held by the worker
+        """
+        return os.path.join(self.path, 'claimed', '{}@{}.json'.format(name, worker))
+
+    def done(self, name):
+        """
+        :param name: the name of the task
+        :return: the name and path of the result of the task
+        """
+        return os.path.join(self.path, 'done', '{}.json'.format(name))
+
+    @staticmethod
+    def write(path, contents):
+        """
+        Atomically write a JSON file
+        :param path: the name and path of the file
+        :param contents: the contents of the file
+        """
+        import json
+        temporary = temporaryfile(path)
+        with open(temporary, 'w') as output:
+            json.dump(contents, output)
+        os.replace(temporary, path)
+
+    def submit(self, name, task):
+        """
+        Add a task to the queue
+        :param name: the name of the task. Tasks are claimed in the order of their names
+        :param task: dictionary describing the task
+        """
+        self.write(self.pending(name), task)
+
+    @staticmethod
+    def run(name):
+        """
+        :param name: the name of a task
+        :return: the name of the run that submitted the task
+        """
+        return name.rsplit('-', 1)[0]
+
+    def claim(self, worker, limit=1, run=None):
+        """
+        Claim tasks from the queue. All the tasks claimed at once are from the same run, so they share their settings
+        :param worker: the name of the worker
+        :param limit: the maximum number of tasks to claim
+        :param run: optionally only claim the tasks of this run
+        :return: list of the name and contents of each task claimed
+        """
+        import json
+        claimed = list()
+        if limit < 1:
+            return claimed
+        for entry in sorted(os.listdir(os.path.join(self.path, 'pending'))):
+            if len(claimed) >= limit:
+                break
+            name, extension = os.path.splitext(entry)
+            if extension != '.json' or entry.startswith('.'):
+                continue
+            if run and self.run(name) != run:
+                continue
+            try:
+                os.rename(self.pending(name), self.claimed(name, worker))
+            except FileNotFoundError:
+                # Another worker claimed the task first
+                continue
+            # Renaming keeps the time the task was submitted, so start the heartbeat now
+            os.utime(self.claimed(name, worker))
+            with open(self.claimed(name, worker)) as task:
+                claimed.append((name, json.load(task)))
+            run = self.run(name)
+        return claimed
+
+    def heartbeat(self, names, worker, stop, lost):
+        """
+        Touch the tasks held by a worker every quarter of the timeout, until stopped
+        :param names: collection of the names of the tasks currently held. It is read again for every heartbeat
+        :param worker: the name of the worker
+        :param stop: threading.Event set once the worker stops
+        :param lost: function called with the name of a task that is still held, but whose claim has disappeared
+        because the task was returned to the queue (e.g. after the worker stalled). The task now belongs to another
+        worker, so it should be abandoned
+        """
+        while not stop.wait(self.timeout / 4):
+            for name in list(names):
                 try:
-                    nesteddictionary[sample].update({header: value})
-                # Create the nested dictionary if it hasn't been created yet
-                except KeyError:
-                    nesteddictionary[sample] = dict()
-                    nesteddictionary[sample].update({header: value})
-        # Create objects for each of the samples, rather than using a nested dictionary. It may have been possible to
-        # skip the creation of the nested dictionary, and create the objects from the original dictionary, but there
-        # seemed to be too many possible places for something to go wrong
-        for line in nesteddictionary:
-            # Create an object for each sample
-            metadata = MetadataObject()
-            # Set the name of the metadata to be the primary key for the sample from the excel file
-            metadata.name = line
-            # Find the headers and values for every sample
-            for header, value in nesteddictionary[line].items():
-                # Try/except for value.encode() - some of the value are type int, so they cannot be encoded
+                    os.utime(self.claimed(name, worker))
+                except FileNotFoundError:
+                    # The task may have been completed since the names were read
+                    if name in names:
+                        lost(name)
+
+    def release(self, name, worker):
+        """
+        Return a task held by a worker to the queue
+        :param name: the name of the task
+        :param worker: the name of the worker
+        """
+        try:
+            os.rename(self.claimed(name, worker), self.pending(name))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, name, worker, result):
+        """
+        Record the result of a task, and remove it from the tasks held by the worker
+        :param name: the name of the task
+        :param worker: the name of the worker
+        :param result: dictionary of the result of the task
+        :return: boolean of whether the result was recorded. It is not if the worker no longer holds the task, as
+        the task was returned to the queue for another worker
+        """
+        # Touching the claim also keeps it from being requeued while the result is written
+        try:
+            os.utime(self.claimed(name, worker))
+        except FileNotFoundError:
+            return False
+        self.write(self.done(name), result)
+        try:
+            os.remove(self.claimed(name, worker))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def claims(self, names):
+        """
+        :param names: set of the names of tasks
+        :return: set of the names of the tasks currently held by any worker
+        """
+        held = set()
+        for entry in os.listdir(os.path.join(self.path, 'claimed')):
+            if entry.endswith('.json'):
+                name = entry[:-len('.json')].rsplit('@', 1)[0]
+                if name in names:
+                    held.add(name)
+        return held
+
+    def now(self):
+        """
+        :return: the current time according to the shared storage. Hosts with different clocks still agree on which
+        heartbeats have stopped, as the times of the task files are set by the same storage
+        """
+        clock = os.path.join(self.path, '.clock')
+        with open(clock, 'a'):
+            pass
+        os.utime(clock)
+        return os.stat(clock).st_mtime
+
+    def requeue(self):
+        """
+        Return the tasks whose heartbeat has stopped to the queue
+        :return: list of the names of the tasks requeued
+        """
+        now = self.now()
+        requeued = list()
+        for entry in os.scandir(os.path.join(self.path, 'claimed')):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stale = now - entry.stat().st_mtime > self.timeout
+            except FileNotFoundError:
+                continue
+            if stale:
+                name = entry.name[:-len('.json')].rsplit('@', 1)[0]
                 try:
-                    # Create each attribute - use the header (in lowercase, and spaces removed) as the attribute name,
-                    # and the value as the attribute value
-                    setattr(metadata, header.replace(' ', '').lower(), str(value))
-                except AttributeError:
-                    setattr(metadata, header.replace(' ', '').lower(), value)
-            # Append the object to the list of objects
-            self.metadata.append(metadata)
+                    os.rename(entry.path, self.pending(name))
+                    requeued.append(name)
+                except FileNotFoundError:
+                    pass
+        return requeued
+
+    def results(self, names):
+        """
+        Collect the results of completed tasks. Their result files are removed once read
+        :param names: set of the names of the tasks
+        :return: dictionary of the result of each of the tasks that is complete
+        """
+        import json
+        results = dict()
+        for entry in os.listdir(os.path.join(self.path, 'done')):
+            name, extension = os.path.splitext(entry)
+            if extension == '.json' and name in names:
+                with open(self.done(name)) as result:
+                    results[name] = json.load(result)
+                os.remove(self.done(name))
+        return results
+
+    def withdraw(self, names):
+        """
+        Remove any of the tasks that have not been claimed from the queue
+        :param names: the names of the tasks
+        :return: list of the names of the tasks removed
+        """
+        withdrawn = list()
+        for name in names:
+            try:
+                os.remove(self.pending(name))
+                withdrawn.append(name)
+            except FileNotFoundError:
+                pass
+        return withdrawn
+
+    def __init__(self, path, timeout=120):
+        """
+        :param path: the spool directory
+        :param timeout: the number of seconds without a heartbeat after which a task is returned to the queue
+        """
+        self.path = os.path.join(path, '')
+        self.timeout = timeout
+        for directory in ['pending', 'claimed', 'done']:
+            make_path(os.path.join(self.path, directory))
+
+
+class MergedStream(io.RawIOBase):
+    """
+    Read-only, seekable file-like view of the concatenation of a list of files, without writing anything. Files are
+    only opened when they are read. As gzip files may consist of multiple members, the stream of a list of .fastq.gz
+    files is itself a valid .fastq.gz stream, and can be wrapped with gzip.GzipFile
+    """
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Move to a position in the concatenated stream
+        :param offset: the offset
+        :param whence: io.SEEK_SET, io.SEEK_CUR, or io.SEEK_END
+        :return: the new position
+        """
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.offsets[-1]
+        self.position = max(0, offset)
+        return self.position
+
+    def seekmember(self, member):
+        """
+        Move to the start of one of the files
+        :param member: the index of the file in the list
+        :return: the new position
+        """
+        return self.seek(self.offsets[member])
+
+    def member(self):
+        """
+        :return: the index of the file containing the current position
+        """
+        from bisect import bisect_right
+        return min(bisect_right(self.offsets, self.position) - 1, len(self.files) - 1)
+
+    def readinto(self, buffer):
+        """
+        Read from the current position into a buffer, never crossing from one file into the next in a single call
+        :param buffer: the writable buffer
+        :return: the number of bytes read. Zero at the end of the stream
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if not self.files or self.position >= self.offsets[-1]:
+            return 0
+        member = self.member()
+        # Lazily open the file, and close the previous one
+        if self.current != member:
+            if self.handle:
+                self.handle.close()
+            self.handle = open(self.files[member], 'rb')
+            self.current = member
+        self.handle.seek(self.position - self.offsets[member])
+        read = self.handle.readinto(memoryview(buffer)[:self.offsets[member + 1] - self.position])
+        # A file that has shrunk since its size was recorded would otherwise silently end the stream early
+        if not read and len(buffer):
+            raise IOError('{} is shorter than its recorded size of {} bytes'
+                          .format(self.files[member], self.offsets[member + 1] - self.offsets[member]))
+        self.position += read
+        return read
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+            self.current = None
+        super(MergedStream, self).close()
+
+    def __init__(self, files, sizes=None):
+        """
+        :param files: list of the names and paths of the files
+        :param sizes: optional list of the sizes of the files, to avoid a stat of each file
+        """
+        super(MergedStream, self).__init__()
+        self.files = list(files)
+        sizes = sizes if sizes else [os.path.getsize(path) for path in self.files]
+        # The offset of the start of each file in the stream, followed by the total size
+        self.offsets = [0]
+        for size in sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        self.position = 0
+        self.current = None
+        self.handle = None
+
+
+class MergedSample(object):
+    """
+    A virtual merge: presents the input files of a sample as single merged R1 and R2 streams, or as iterators of reads,
+    without writing a merged copy. The storage and I/O of the merge are only paid once, when the reads are consumed.
+    Virtual merges are described by manifests in the same format as those of merged samples (but written to
+    sample_virtual.json, so that they never replace them), so either can be opened
+
+    e.g.
+    sample = MergedSample.frommanifest('/path/sample/sample_virtual.json')
+    for forward, reverse in sample.pairs():
+        ...
+    """
+
+    @classmethod
+    def fromsample(cls, sample):
+        """
+        :param sample: a sample record populated by Merger.idfind
+        :return: the virtual merge of the sample
+        """
+        files = dict()
+        for read in ['1', '2']:
+            files['R{}'.format(read)] = [{'path': record['path'], 'size': record['size'], 'mtime': record['mtime']}
+                                         for record in sample.general.fastqrecords if record['read'] == read]
+        return cls(sample.name, files)
+
+    @classmethod
+    def frommanifest(cls, manifestfile):
+        """
+        :param manifestfile: the name and path of a manifest of a virtual or merged sample
+        :return: the virtual merge of the sample
+        """
+        import json
+        with open(manifestfile) as manifest:
+            manifest = json.load(manifest)
+        return cls(manifest['sample'], {read: entry['inputs'] for read, entry in manifest['files'].items()})
+
+    def tomanifest(self, manifestfile):
+        """
+        Write the manifest of the virtual merge
+        :param manifestfile: the name and path of the manifest
+        """
+        writemanifest(manifestfile, self.name, {read: {'inputs': inputs, 'format': 'virtual'}
+                                                for read, inputs in self.files.items()})
+
+    def open(self, read='R1'):
+        """
+        :param read: the read direction (R1/R2)
+        :return: a seekable stream of the merged (compressed) file
+        """
+        return MergedStream([x['path'] for x in self.files[read]], [x['size'] for x in self.files[read]])
+
+    def reads(self, read='R1'):
+        """
+        Iterate through the reads of the merged file, opening and decompressing each input file in turn
+        :param read: the read direction (R1/R2)
+        :return: iterator of the (header, sequence, quality) of each read
+        """
+        import gzip
+        for entry in self.files[read]:
+            with open(entry['path'], 'rb') as source:
+                compressed = source.read(2) == b'\x1f\x8b'
+            with (gzip.open(entry['path'], 'rb') if compressed else open(entry['path'], 'rb')) as fastq:
+                for header in fastq:
+                    sequence, _, quality = next(fastq), next(fastq), next(fastq)
+                    yield header.rstrip(), sequence.rstrip(), quality.rstrip()
+
+    def pairs(self):
+        """
+        :return: iterator of the forward and reverse reads of each read pair
+        """
+        return zip(self.reads('R1'), self.reads('R2'))
+
+    def __init__(self, name, files):
+        """
+        :param name: the name of the sample
+        :param files: dictionary of the path, size, and modification time of each of the input files for each read
+        direction (R1/R2)
+        """
+        self.name = name
+        self.files = files
+
+
+class Merger(object):
+
+    def idseek(self):
+        """Read the samples, and the seq IDs to merge for each sample, from the seq ID file"""
+        self.metadata = list(readseqids(self.idfile, self.delimiter))
         for sample in self.metadata:
             # Sort the seqIDs
-            sample.merge = sorted(sample.merge.split(self.delimiter))
+            sample.merge = sorted(sample.merge)
 
     def idfind(self):
-        """Find the fastq files associated with the seq IDs pulled from the seq ID file. Populate a MetadataObject
-        with the name of the merged files as well as the fastq file names and paths"""
+        """Find the fastq files associated with the seq IDs pulled from the seq ID file. Populate the record of each
+        sample with the name of the merged files as well as the fastq file names and paths"""
+        # Read the directory once rather than globbing it for every seq ID
+        self.index = FastqIndex(self.path, self.persistindex)
         for sample in self.metadata:
-            # Create the general category for the MetadataObject
+            # Create the general category for the sample
             sample.general = GenObject()
             sample.general.fastqfiles = list()
+            sample.general.fastqrecords = list()
             for ids in sample.merge:
                 # Ensure that the id exists. Dues to the way the ids were pulled from the file, newline characters
                 # will be entered into the list. Skip them
                 if ids:
-                    # Glob for files in the path with the seq ID and 'fastq'
-                    idfile = glob('{}{}*fastq*'.format(self.path, ids))
+                    # Find the files in the path with the seq ID and 'fastq'
+                    records = self.index.find(ids)
                     # Assertion to ensure that all the files specified in :self.idfile are present in the path
-                    assert idfile, 'Cannot find files for seq ID: {}. Please check that the seqIDs ' \
-                                   'provided in the seq ID file match the files present in the path'.format(ids)
+                    assert records, 'Cannot find files for seq ID: {}. Please check that the seqIDs ' \
+                                    'provided in the seq ID file match the files present in the path'.format(ids)
                     # Append the fastq file and path and the seq ID to the appropriate list
-                    sample.general.fastqfiles.append(idfile)
+                    sample.general.fastqfiles.append([record['path'] for record in records])
+                    sample.general.fastqrecords.extend(records)
+
+    def verify(self):
+        """
+        Check the integrity of all the input files on a pool of processes before any merging starts. Files already
+        verified, and unchanged (same size and modification time) since, are not checked again
+        """
+        import json
+        from concurrent.futures import ProcessPoolExecutor
+        cachefile = '{}.verifycache.json'.format(self.path)
+        try:
+            with open(cachefile) as cache:
+                verified = json.load(cache)
+        except (IOError, OSError, ValueError):
+            verified = dict()
+        records = {record['path']: record for sample in self.metadata for record in sample.general.fastqrecords}
+        # A full verification also satisfies a fast one
+        modes = ['fast', 'full'] if self.verification == 'fast' else ['full']
+        unverified = [record for path, record in sorted(records.items())
+                      if verified.get(path, {}).get('size') != record['size'] or
+                      verified.get(path, {}).get('mtime') != record['mtime'] or
+                      verified.get(path, {}).get('mode') not in modes]
+        printtime(u'Verifying {} files ({} previously verified)'
+                  .format(len(unverified), len(records) - len(unverified)), self.start)
+        bad = list()
+        # Decompressing is CPU-bound, so there is a process for each CPU unless a limit was requested
+        with ProcessPoolExecutor(max_workers=self.cpus) as executor:
+            paths = [record['path'] for record in unverified]
+            for record, problem in zip(unverified, executor.map(verifyfile, paths, [self.verification] * len(paths),
+                                                                chunksize=16)):
+                if problem:
+                    printtime(u'{} is {}'.format(record['path'], problem), self.start)
+                    bad.append(record['path'])
+                else:
+                    verified[record['path']] = {'size': record['size'], 'mtime': record['mtime'],
+                                                'mode': self.verification}
+        self.metrics.increment('verifiedfiles', len(unverified) - len(bad))
+        self.metrics.increment('badfiles', len(bad))
+        if unverified:
+            temporary = temporaryfile(cachefile)
+            with open(temporary, 'w') as cache:
+                json.dump(verified, cache)
+            os.replace(temporary, cachefile)
+        assert not bad, 'The following files failed verification: {}'.format(', '.join(bad))
 
     def idmerge(self):
         """Merge the files together"""
-        from threading import Thread
-        #
-        for i in range(self.cpus):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.merge, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
+        import asyncio
+        # Only describe the merges if virtual merges were requested
+        if self.virtual:
+            for sample in self.metadata:
+                sample.general.outputdir = '{}{}'.format(self.path, sample.name)
+                make_path(sample.general.outputdir)
+                # The manifest of any real merge of the sample is kept, so that its merged files are still up to date
+                sample.general.manifestfile = '{}/{}_virtual.json'.format(sample.general.outputdir, sample.name)
+                MergedSample.fromsample(sample).tomanifest(sample.general.manifestfile)
+            printtime(u'Wrote virtual merge manifests for {} samples'.format(len(self.metadata)), self.start)
+            return
+        jobs = list()
+        cachedfiles = 0
         for sample in self.metadata:
-            # Initialise strings to hold the forward and reverse fastq files
-            forwardfiles = list()
-            reversefiles = list()
             # Create the output directory
             sample.general.outputdir = '{}{}'.format(self.path, sample.name)
             make_path(sample.general.outputdir)
-            # Iterate through the samples
-            for files in sample.general.fastqfiles:
-                # Find the forward and reverse files (forward files must have have either _R1_ or _1_
-                for fastq in files:
-                    if '_R1_' in fastq or '_1_' in fastq or '_1.' in fastq:
-                        forwardfiles.append(fastq)
-                    elif '_R2_' in fastq or '_2_' in fastq or '_2.' in fastq:
-                        reversefiles.append(fastq)
+            # Find the forward and reverse files using the read direction parsed from the file names by the index.
+            # Keep the records as well, as they hold the size and device of each file
+            forwardrecords = [record for record in sample.general.fastqrecords if record['read'] == '1']
+            reverserecords = [record for record in sample.general.fastqrecords if record['read'] == '2']
+            forwardfiles = [record['path'] for record in forwardrecords]
+            reversefiles = [record['path'] for record in reverserecords]
+            destination = os.stat(sample.general.outputdir).st_dev
             # Add the files to the processing queue
             sample.general.outputforward = '{}/{}_S1_L001_R1_001.fastq.gz'.format(sample.general.outputdir, sample.name)
             sample.general.outputreverse = '{}/{}_S1_L001_R2_001.fastq.gz'.format(sample.general.outputdir, sample.name)
+            # The merged files are written to temporary files, and only renamed into place once complete
+            forwardtemporary = temporaryfile(sample.general.outputforward)
+            reversetemporary = temporaryfile(sample.general.outputreverse)
             # Add the command object to self.data
             sample.commands = GenObject()
-            sample.commands.forwardmerge = 'cat {} > {}'.format(' '.join(forwardfiles), sample.general.outputforward)
-            sample.commands.reversemerge = 'cat {} > {}'.format(' '.join(reversefiles), sample.general.outputreverse)
-            # Add the commands to the queue
-            self.mergequeue.put((sample.commands.forwardmerge, sample.general.outputforward))
-            self.mergequeue.put((sample.commands.reversemerge, sample.general.outputreverse))
-        # Join the threads
-        self.mergequeue.join()
-
-    def merge(self):
-        while True:  # while daemon
-            # Unpack the merge command and the output file from the queue
-            (mergecommand, outputfile) = self.mergequeue.get()
-            # Don't run the command if the output file exists
-            if not os.path.isfile(outputfile):
+            sample.commands.forwardmerge = 'cat {} > {}'.format(' '.join(forwardfiles), forwardtemporary)
+            sample.commands.reversemerge = 'cat {} > {}'.format(' '.join(reversefiles), reversetemporary)
+            # The manifest records the inputs of each merged file. Merged files whose inputs are unchanged since
+            # the manifest was written are not merged again
+            sample.general.manifestfile = '{}/{}_manifest.json'.format(sample.general.outputdir, sample.name)
+            sample.general.manifest = readmanifest(sample.general.manifestfile)
+            # Read statistics from previous runs are kept (in the manifest entries of the files they describe) for the
+            # merged files that are not merged again
+            sample.general.statisticsfile = '{}/{}_statistics.json'.format(sample.general.outputdir, sample.name)
+            sample.general.statistics = {read: entry['statistics'] for read, entry in sample.general.manifest.items()
+                                         if 'statistics' in entry}
+            sample.general.pending = 0
+            cached = 0
+            # Subsampling selects the same pairs from the forward and reverse reads, so both are created by one job
+            if self.subsampling:
+                job, cached = self.subsamplejob(sample, forwardrecords, reverserecords, forwardtemporary,
+                                                reversetemporary, destination)
+                if job:
+                    jobs.append(job)
+                    sample.general.pending += 1
+            else:
+                # Create a job for each of the merged files
+                for read, records, command, outputfile, temporary in [
+                        ('R1', forwardrecords, sample.commands.forwardmerge, sample.general.outputforward,
+                         forwardtemporary),
+                        ('R2', reverserecords, sample.commands.reversemerge, sample.general.outputreverse,
+                         reversetemporary)]:
+                    inputs = [{'path': record['path'], 'size': record['size'], 'mtime': record['mtime']}
+                              for record in records]
+                    if self.uptodate(sample.general.manifest.get(read), inputs, outputfile, self.format) and \
+                            (not self.statistics or read in sample.general.statistics):
+                        continue
+                    # Reuse an identical merge from the cache if possible
+                    cachekey = self.cache.key(inputs, self.format) if self.cache else None
+                    if cachekey and self.fetch(sample, read, cachekey, inputs, outputfile):
+                        cached += 1
+                        continue
+                    job = GenObject()
+                    job.sample = sample
+                    job.read = read
+                    job.inputs = inputs
+                    job.inputfiles = [record['path'] for record in records]
+                    job.command = command
+                    job.outputfile = outputfile
+                    job.temporaryfile = temporary
+                    job.cachekey = cachekey
+                    # The total size of the input files is used to schedule the largest jobs first
+                    job.size = sum(record['size'] for record in records)
+                    # The filesystems the job reads from and writes to, so their concurrency can be limited
+                    job.destination = destination
+                    job.devices = {self.device(record) for record in records} | {destination}
+                    jobs.append(job)
+                    sample.general.pending += 1
+            # Write the manifest of samples completed entirely from the cache
+            if cached and not sample.general.pending:
+                self.completesample(sample)
+            cachedfiles += cached
+        # Each subsampling job creates both the forward and reverse files of a sample
+        mergefiles = 2 * len(jobs) if self.subsampling else len(jobs)
+        printtime(u'{} merged files are up to date, {} retrieved from the cache, {} to be merged'
+                  .format(2 * len(self.metadata) - mergefiles - cachedfiles, cachedfiles, mergefiles), self.start)
+        # Run all the jobs from a single event loop, or hand them to the workers of the spool
+        try:
+            failed = self.distribute(jobs) if self.spool else asyncio.run(self.supervise(jobs, self.runjob))
+        except KeyboardInterrupt:
+            printtime(u'Keyboard interrupt! Incomplete merged files have been removed.', self.start)
+            sys.exit()
+        assert not failed, 'Could not create the following merged files: {}'.format(', '.join(failed))
+        # Summarise the read statistics of all the samples in a single table
+        if self.statistics:
+            writestatisticstable('{}readstatistics.tsv'.format(self.path), self.metadata)
+        # Summarise the fraction of the read pairs of each sample kept by subsampling
+        if self.subsampling:
+            writesubsamplingtable('{}subsampling.tsv'.format(self.path), self.metadata, self.genomesize)
+
+    def subsamplejob(self, sample, forwardrecords, reverserecords, forwardtemporary, reversetemporary, destination):
+        """
+        Create the job that subsamples the read pairs of a sample, unless both of its subsampled files are up to date,
+        or can be retrieved from the cache
+        :param sample: the sample record
+        :param forwardrecords: list of the index records of the forward fastq files
+        :param reverserecords: list of the index records of the reverse fastq files
+        :param forwardtemporary: name and path of the temporary forward file
+        :param reversetemporary: name and path of the temporary reverse file
+        :param destination: the device of the output directory
+        :return: the job (or None if there is nothing to merge), and the number of files retrieved from the cache
+        """
+        records = {'R1': forwardrecords, 'R2': reverserecords}
+        outputfiles = {'R1': sample.general.outputforward, 'R2': sample.general.outputreverse}
+        inputs = {read: [{'path': record['path'], 'size': record['size'], 'mtime': record['mtime']}
+                         for record in records[read]] for read in records}
+        if all(self.uptodate(sample.general.manifest.get(read), inputs[read], outputfiles[read], self.format) and
+               (not self.statistics or read in sample.general.statistics) for read in records):
+            return None, 0
+        # The pairs selected depend on the inputs of both reads, so both are part of the cache key of each file
+        cachekeys = {read: self.cache.key(inputs['R1'] + inputs['R2'], '{}:{}'.format(self.format, read))
+                     for read in records} if self.cache else dict()
+        if cachekeys and all(self.fetch(sample, read, cachekeys[read], inputs[read], outputfiles[read])
+                             for read in records):
+            return None, 2
+        job = GenObject()
+        job.sample = sample
+        job.read = 'R1/R2'
+        job.inputs = inputs
+        job.inputfiles = {read: [record['path'] for record in records[read]] for read in records}
+        job.outputfiles = outputfiles
+        job.outputfile = ' and '.join(outputfiles.values())
+        job.temporaryfiles = {'R1': forwardtemporary, 'R2': reversetemporary}
+        job.cachekeys = cachekeys
+        job.size = sum(record['size'] for read in records for record in records[read])
+        job.destination = destination
+        job.devices = {self.device(record) for read in records for record in records[read]} | {destination}
+        return job, 0
+
+    async def supervise(self, jobs, work, refill=None):
+        """
+        Run the merge jobs concurrently, and wait for them to finish. Workers sleep until their copy or process has
+        finished rather than polling it, so CPU usage reflects the work actually being done. Printing the progress
+        and cleaning up after an interruption are both handled here
+        :param jobs: list of the jobs to run
+        :param work: coroutine function that runs a job
+        :param refill: optional function returning more jobs to run as jobs finish. See Scheduler.run
+        :return: list of the output files that could not be created
+        """
+        import asyncio
+        import multiprocessing
+        from concurrent.futures import ThreadPoolExecutor
+        from time import time
+        jobs = list(jobs)
+        workers = self.concurrency(jobs)
+        scheduler = Scheduler(workers, self.sourcejobs, self.destinationjobs, self.autotune)
+        # In-process concatenations are blocking, so they are run in a pool of threads
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Recompressed blocks from all the merges are compressed by a shared pool with a thread for each CPU
+        self.compressor = ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) if self.recompress else None
+        # The output files currently being written
+        self.active = set()
+        # The progress of the merges, for the progress line, and the utilisation of the workers
+        self.totalbytes = sum(job.size for job in jobs)
+        self.mergedbytes = 0
+        self.busy = 0
+        self.queued = time()
+        # The number of jobs currently running
+        self.running = 0
+
+        async def run(job):
+            self.running += 1
+            try:
+                return await work(job)
+            finally:
+                self.running -= 1
+
+        def more(free):
+            # Keep the jobs added along the way, so that their failures are reported too
+            added = refill(free)
+            jobs.extend(added)
+            self.totalbytes += sum(job.size for job in added)
+            return added
+
+        progress = asyncio.ensure_future(self.progress())
+        try:
+            results = await scheduler.run(jobs, run, more if refill else None)
+        finally:
+            progress.cancel()
+            # Finish the progress line
+            if self.progressline:
+                sys.stdout.write('\n')
+            # Let any copies in progress finish (they cannot be interrupted), and discard the copies that never started
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            if self.compressor:
+                self.compressor.shutdown(wait=True, cancel_futures=True)
+            # Remove any incomplete output files
+            for outputfile in list(self.active):
+                try:
+                    os.remove(outputfile)
+                except OSError:
+                    pass
+        failed = list()
+        for job in jobs:
+            result = results.get(id(job))
+            if isinstance(result, Exception):
+                job.error = str(result)
+                printtime(u'Could not create {}: {}'.format(job.outputfile, result), self.start)
+                self.metrics.event('job', sample=str(job.sample.name), read=job.read, output=job.outputfile,
+                                   error=str(result))
+                self.metrics.increment('failedjobs')
+                failed.append(job.outputfile)
+        # The fraction of the available worker time spent merging
+        elapsed = time() - self.queued
+        self.metrics.event('utilisation', workers=workers, seconds=elapsed, busy=self.busy,
+                           utilisation=self.busy / (workers * elapsed) if elapsed else 0,
+                           limits={str(device): limit.limit for device, limit in scheduler.limits.items()})
+        return failed
+
+    def concurrency(self, jobs):
+        """
+        :param jobs: list of the jobs to run
+        :return: the maximum number of jobs to run at the same time. Unless a total was requested, this is as many as
+        the limits of the filesystems the jobs use allow, as the jobs are I/O-bound rather than CPU-bound
+        """
+        if self.cpus:
+            return self.cpus
+        devices = {device for job in jobs for device in job.devices}
+        return max(1, len(devices) * max(self.sourcejobs, self.destinationjobs))
+
+    async def runjob(self, job):
+        """
+        Run a job, and write the manifest of its sample once all the merged files of the sample are complete
+        :param job: the job to run
+        :return: the number of bytes merged
+        """
+        size = await (self.subsamplemerge(job) if self.subsampling else self.merge(job))
+        self.finishjob(job)
+        return size
+
+    def finishjob(self, job):
+        """
+        Write the manifest of the sample of a completed job once none of the sample's jobs are pending
+        :param job: the completed job
+        """
+        job.sample.general.pending -= 1
+        if not job.sample.general.pending:
+            self.completesample(job.sample)
+
+    def distribute(self, jobs):
+        """
+        Submit the jobs to the spool as tasks, and wait for the workers (on this or any other host) to complete them.
+        Optionally start workers on this host as well. The manifests are written here as the results arrive, so
+        workers never write to the same manifest
+        :param jobs: list of the jobs to run
+        :return: list of the output files that could not be created
+        """
+        import signal
+        import subprocess
+        import uuid
+        from time import sleep, time
+        if not jobs:
+            return list()
+        # Treat termination (e.g. by a cluster scheduler) like an interruption, so that the tasks are withdrawn
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        run = uuid.uuid4().hex[:12]
+        arguments = {argument: self.args.get(argument) for argument in SPOOLARGUMENTS}
+        tasks = dict()
+        # Tasks are claimed in the order of their names, so the largest are merged first
+        for index, job in enumerate(sorted(jobs, key=lambda x: x.size, reverse=True)):
+            name = '{}-{:06d}'.format(run, index)
+            self.spool.submit(name, self.task(job, arguments))
+            tasks[name] = job
+        printtime(u'Submitted {} tasks to {}'.format(len(tasks), self.spool.path), self.start)
+
+        def start():
+            return subprocess.Popen([sys.executable, os.path.abspath(__file__), self.spool.path, '--worker',
+                                     '--spooltimeout', str(self.spool.timeout)] +
+                                    (['-t', str(self.cpus)] if self.cpus else []))
+
+        def fail(name, error, worker):
+            job = tasks.pop(name)
+            printtime(u'Could not create {}: {}{}'.format(job.outputfile, error, ' (worker {})'.format(worker)
+                                                        if worker else ''), self.start)
+            self.metrics.event('task', sample=str(job.sample.name), read=job.read, task=name, worker=worker,
+                               error=error)
+            self.metrics.increment('failedjobs')
+            failed.append(job.outputfile)
+
+        workers = [start() for _ in range(self.workers)]
+        # The number of workers on this host that have crashed
+        crashed = 0
+        failed = list()
+        queued = time()
+        try:
+            while tasks:
+                # Replace the workers on this host that have stopped. Workers stop after being idle for a while (e.g.
+                # while workers on other hosts hold the remaining tasks), or crash. Crashed workers are only replaced
+                # until as many have crashed as were started, as they are then unlikely to be doing any better
+                for worker in list(workers):
+                    if worker.poll() is None:
+                        continue
+                    workers.remove(worker)
+                    if worker.returncode:
+                        crashed += 1
+                        printtime(u'A worker on this host exited with status {}'.format(worker.returncode),
+                                  self.start)
+                        self.metrics.increment('crashedworkers')
+                    if crashed < self.workers:
+                        workers.append(start())
+                for name in self.spool.requeue():
+                    if name in tasks:
+                        printtime(u'The worker merging {} stopped. Returned it to the spool'
+                                  .format(tasks[name].outputfile), self.start)
+                        self.metrics.increment('requeuedtasks')
+                for name, result in sorted(self.spool.results(set(tasks)).items()):
+                    if 'error' in result:
+                        fail(name, result['error'], result['worker'])
+                        continue
+                    job = tasks.pop(name)
+                    job.sample.general.manifest.update(result['manifest'])
+                    job.sample.general.statistics.update(result['statistics'])
+                    self.finishjob(job)
+                    printtime(u'{} merged {} ({})'.format(result['worker'], job.outputfile,
+                                                          throughput(job.size, result['seconds'])), self.start)
+                    self.metrics.increment('bytesmerged', job.size)
+                    self.metrics.increment('mergedfiles', len(result['manifest']))
+                    self.metrics.event('task', sample=str(job.sample.name), read=job.read, task=name,
+                                       worker=result['worker'], bytes=job.size, seconds=result['seconds'],
+                                       wait=time() - queued - result['seconds'])
+                # Once the workers of this host have all crashed, the tasks that no other host is merging would wait
+                # forever. The tasks still held (including those of the crashed workers, until they are requeued) are
+                # waited for
+                if self.workers and not workers and not self.spool.claims(set(tasks)):
+                    for name in sorted(self.spool.withdraw(tasks)):
+                        fail(name, 'the workers on this host crashed, and no other worker claimed it', None)
+                if tasks:
+                    sleep(1)
+        except KeyboardInterrupt:
+            # Stop the workers on this host first, as they return their incomplete tasks to the spool, and these must
+            # be withdrawn too. Tasks held by other hosts are finished, as other runs may be waiting for the same files
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+            self.spool.withdraw(tasks)
+            # Discard the results that nobody will collect
+            self.spool.results(set(tasks))
+            printtime(u'Keyboard interrupt! Unclaimed tasks have been removed from the spool.', self.start)
+            raise
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.wait()
+        return failed
+
+    def task(self, job, arguments):
+        """
+        :param job: a merge job
+        :param arguments: dictionary of the arguments that determine how the merged files are created
+        :return: dictionary describing the job for a worker
+        """
+        task = {'sample': str(job.sample.name), 'read': job.read, 'inputs': job.inputs, 'inputfiles': job.inputfiles,
+                'outputfile': job.outputfile, 'size': job.size, 'arguments': arguments}
+        if self.subsampling:
+            task.update({'outputfiles': job.outputfiles, 'cachekeys': job.cachekeys})
+        else:
+            task['cachekey'] = job.cachekey
+        return task
+
+    def taskjob(self, task):
+        """
+        :param task: dictionary describing a merge job, as submitted to the spool
+        :return: the merge job. The temporary files and devices are those of this host
+        """
+        sample = GenObject()
+        sample.name = task['sample']
+        sample.general = GenObject()
+        sample.general.manifest = dict()
+        sample.general.statistics = dict()
+        job = GenObject()
+        job.sample = sample
+        job.read = task['read']
+        job.inputs = task['inputs']
+        job.inputfiles = task['inputfiles']
+        job.outputfile = task['outputfile']
+        job.size = task['size']
+        job.error = None
+        if self.subsampling:
+            job.outputfiles = task['outputfiles']
+            job.temporaryfiles = {read: temporaryfile(path) for read, path in job.outputfiles.items()}
+            job.cachekeys = task['cachekeys']
+            outputfiles = list(job.outputfiles.values())
+            inputfiles = [path for paths in job.inputfiles.values() for path in paths]
+        else:
+            job.temporaryfile = temporaryfile(job.outputfile)
+            job.command = 'cat {} > {}'.format(' '.join(job.inputfiles), job.temporaryfile)
+            job.cachekey = task['cachekey']
+            outputfiles = [job.outputfile]
+            inputfiles = job.inputfiles
+        # Devices are numbered separately by each host
+        job.destination = os.stat(os.path.dirname(outputfiles[0])).st_dev
+        job.devices = {os.stat(path).st_dev for path in inputfiles} | {job.destination}
+        return job
+
+    def work(self, idle):
+        """
+        Claim and merge tasks from the spool until there have been none to claim for a while. Up to one task for each
+        thread is held at a time, and merged concurrently, as the coordinator would merge them. Each task is completed
+        as soon as it is merged, and another is claimed in its place. Tasks from different runs may be merged
+        differently, so only tasks from the same run are held at once
+        :param idle: the number of seconds without any tasks after which to stop
+        """
+        import asyncio
+        import signal
+        import threading
+        from time import sleep, time
+        # Treat termination like an interruption, so that incomplete files are removed and claims are released
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        limit = self.cpus or max(self.sourcejobs, self.destinationjobs)
+        # The tasks held by this worker, with the future merging each of them once it has started
+        held = dict()
+        # The tasks that were returned to the spool while they were held
+        lost = set()
+
+        def abandon(name):
+            # Called by the heartbeat thread. The task belongs to another worker now, so stop merging it
+            lost.add(name)
+            merging = held.get(name)
+            if merging:
+                merging.get_loop().call_soon_threadsafe(merging.cancel)
+
+        def jobs(claimed):
+            # Tasks that cannot be merged on this host are completed with the error straight away
+            created = list()
+            for name, task in claimed:
+                try:
+                    job = self.taskjob(task)
+                except OSError as exception:
+                    self.spool.complete(name, self.worker, {'error': str(exception), 'worker': self.worker})
+                    continue
+                job.task = name
+                held[name] = None
+                created.append(job)
+            return created
+
+        async def timed(job):
+            # Record how long each task took, for the coordinator
+            began = time()
+            merging = asyncio.ensure_future(self.subsamplemerge(job) if self.subsampling else self.merge(job))
+            held[job.task] = merging
+            if job.task in lost:
+                merging.cancel()
+            try:
+                size = await merging
+            except asyncio.CancelledError:
+                if job.task not in lost:
+                    raise
+                held.pop(job.task)
+                printtime(u'Worker {} abandoned {}, as it was returned to the spool for another worker'
+                          .format(self.worker, job.outputfile), self.start)
+                return 0
+            except Exception as exception:
+                held.pop(job.task)
+                self.spool.complete(job.task, self.worker, {'error': str(exception), 'worker': self.worker})
+                raise
+            held.pop(job.task)
+            if not self.spool.complete(job.task, self.worker, {
+                    'manifest': job.sample.general.manifest, 'statistics': job.sample.general.statistics,
+                    'worker': self.worker, 'seconds': time() - began}):
+                printtime(u'Worker {} merged {}, but it had already been returned to the spool for another worker'
+                          .format(self.worker, job.outputfile), self.start)
+            return size
+
+        printtime(u'Worker {} merging tasks from {}'.format(self.worker, self.spool.path), self.start)
+        # Keep the claims alive while the tasks are merged
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.spool.heartbeat, daemon=True,
+                                     args=(held, self.worker, stop, abandon))
+        heartbeat.start()
+        last = time()
+        try:
+            while time() - last < idle:
+                self.spool.requeue()
+                claimed = self.spool.claim(self.worker, limit)
+                if not claimed:
+                    sleep(1)
+                    continue
+                # All the tasks held at once are from the same run, so they are merged the same way
+                self.configure(claimed[0][1]['arguments'])
+                run = self.spool.run(claimed[0][0])
+                asyncio.run(self.supervise(jobs(claimed), timed, lambda free: jobs(
+                    self.spool.claim(self.worker, min(free, limit - len(held)), run))))
+                last = time()
+            printtime(u'Worker {} stopped after {:.0f} s without any tasks'.format(self.worker, idle), self.start)
+        except KeyboardInterrupt:
+            for name in list(held):
+                self.spool.release(name, self.worker)
+            printtime(u'Worker {} stopped. {} incomplete tasks were returned to the spool'
+                      .format(self.worker, len(held)), self.start)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    async def merge(self, job):
+        """
+        Create a merged file, unless it already exists
+        :param job: the job containing the files to merge, the merge command, and the output file
+        :return: the number of bytes merged
+        """
+        import asyncio
+        from functools import partial
+        from time import time
+        loop = asyncio.get_running_loop()
+        started = time()
+        self.active.add(job.temporaryfile)
+        # Optionally collect the read statistics while the files are merged
+        statistics = ReadStatistics() if self.statistics else None
+        # Optionally recompress the reads into a BGZF file with a .gzi index
+        if self.recompress:
+            indexfile = temporaryfile('{}.gzi'.format(job.outputfile))
+            self.active.add(indexfile)
+            size, written, seconds = await loop.run_in_executor(
+                self.executor, partial(recompress, job.inputfiles, job.temporaryfile, self.compressor, indexfile,
+                                       statistics=statistics))
+            printtime(u'Recompressed {} ({} uncompressed, {}). {} bytes compared to {} bytes concatenated ({:.1f}%)'
+                      .format(os.path.basename(job.outputfile), throughput(size, seconds),
+                              throughput(written, seconds), written, job.size,
+                              100 * written / job.size if job.size else 0), self.start)
+        # Concatenate the files in-process unless the shell backend was requested
+        elif self.backend == 'native':
+            size, seconds = await loop.run_in_executor(
+                self.executor, concatenate, job.inputfiles, job.temporaryfile, statistics)
+            printtime(u'Merged {} ({})'.format(os.path.basename(job.outputfile), throughput(size, seconds)),
+                      self.start)
+        else:
+            await self.execute(job.command)
+            # The shell cannot collect the statistics, so they take a second pass over the merged file
+            if statistics is not None:
+                secondpass = time()
+                await loop.run_in_executor(self.executor, lambda: [statistics.update(data) for data in
+                                                                   decompress([job.temporaryfile])])
+                seconds = time() - secondpass
+        if statistics is not None:
+            job.sample.general.statistics[job.read] = statistics.summary()
+            # The time the statistics add to the job. Recompressing decompresses the reads anyway, but a native merge
+            # has to decompress them instead of letting the kernel copy the files, so the whole merge is the cost
+            overhead = statistics.seconds if self.recompress else seconds
+            printtime(u'Collected read statistics for {}: {:.2f} s added to the merge ({:.2f} s analysing the reads{})'
+                      .format(os.path.basename(job.outputfile), overhead, statistics.seconds,
+                              ', the rest decompressing them' if self.backend == 'native' and not self.recompress
+                              else ''), self.start)
+        # Optionally record checksums of the inputs and the merged file in the manifest
+        if self.checksum:
+            checksums = await loop.run_in_executor(
+                self.executor, lambda: [md5sum(path) for path in job.inputfiles + [job.temporaryfile]])
+            for entry, checksum in zip(job.inputs, checksums):
+                entry['md5'] = checksum
+        # Move the complete file (and its index) into place
+        if self.recompress:
+            os.replace(indexfile, '{}.gzi'.format(job.outputfile))
+            self.active.discard(indexfile)
+        elif os.path.isfile('{}.gzi'.format(job.outputfile)):
+            # Remove the index of a previous recompressed file, as it does not describe the concatenated file
+            os.remove('{}.gzi'.format(job.outputfile))
+        os.replace(job.temporaryfile, job.outputfile)
+        self.active.discard(job.temporaryfile)
+        stat = os.stat(job.outputfile)
+        job.sample.general.manifest[job.read] = {'output': job.outputfile, 'size': stat.st_size,
+                                                 'mtime': stat.st_mtime_ns, 'inputs': job.inputs,
+                                                 'format': self.format}
+        if self.checksum:
+            job.sample.general.manifest[job.read]['md5'] = checksums[-1]
+        self.recordstatistics(job.sample, job.read)
+        # Add the merged file (and its index and statistics) to the cache. The merge itself has succeeded, so a
+        # failure to cache it is only reported
+        if job.cachekey:
+            try:
+                await loop.run_in_executor(self.executor, partial(
+                    self.cache.store, job.cachekey, job.outputfile, sidecars=['.gzi'] if self.recompress else [],
+                    metadata={'statistics': job.sample.general.statistics[job.read]} if self.statistics else None))
+            except OSError as exception:
+                printtime(u'Could not add {} to the cache: {}'.format(job.outputfile, exception), self.start)
+        # Record the job, and the time it spent waiting to be started
+        seconds = time() - started
+        self.busy += seconds
+        self.mergedbytes += job.size
+        self.metrics.increment('bytesmerged', job.size)
+        self.metrics.increment('byteswritten', stat.st_size)
+        self.metrics.increment('mergedfiles')
+        self.metrics.event('job', sample=str(job.sample.name), read=job.read, output=job.outputfile,
+                           inputs=len(job.inputfiles), bytes=job.size, written=stat.st_size, format=self.format,
+                           seconds=seconds, wait=started - self.queued, throughput=job.size / seconds / 1048576
+                           if seconds else 0, statisticsseconds=overhead if statistics is not None else None)
+        return job.size
+
+    async def subsamplemerge(self, job):
+        """
+        Create the subsampled forward and reverse files of a sample
+        :param job: the job containing the files to subsample, and the output files
+        :return: the number of bytes subsampled
+        """
+        import asyncio
+        from functools import partial
+        from time import time
+        loop = asyncio.get_running_loop()
+        started = time()
+        reads = ['R1', 'R2']
+        self.active.update(job.temporaryfiles.values())
+        statistics = {read: ReadStatistics() if self.statistics else None for read in reads}
+        # The selection only depends on the seed and the inputs (not e.g. the name of the sample, which is not part of
+        # the cache key), so a sample fetched from the cache is identical to one subsampled again
+        report = await loop.run_in_executor(self.executor, partial(
+            subsample, job.inputfiles['R1'], job.inputfiles['R2'], job.temporaryfiles['R1'], job.temporaryfiles['R2'],
+            self.seed, pairs=self.subsample, bases=self.targetbases,
+            statistics=(statistics['R1'], statistics['R2'])))
+        subsampleseconds = report.pop('seconds')
+        printtime(u'Subsampled {} to {} of {} read pairs ({:.1f}%) in {:.1f} s'
+                  .format(job.sample.name, report['selected'], report['pairs'], 100 * report['ratio'],
+                          subsampleseconds), self.start)
+        written = 0
+        for read in reads:
+            outputfile = job.outputfiles[read]
+            if statistics[read] is not None:
+                job.sample.general.statistics[read] = statistics[read].summary()
+            if self.checksum:
+                checksums = await loop.run_in_executor(
+                    self.executor, lambda: [md5sum(path) for path in job.inputfiles[read] +
+                                            [job.temporaryfiles[read]]])
+                for entry, checksum in zip(job.inputs[read], checksums):
+                    entry['md5'] = checksum
+            # Remove the index of a previous recompressed file, as it does not describe the subsampled file
+            if os.path.isfile('{}.gzi'.format(outputfile)):
+                os.remove('{}.gzi'.format(outputfile))
+            os.replace(job.temporaryfiles[read], outputfile)
+            self.active.discard(job.temporaryfiles[read])
+            stat = os.stat(outputfile)
+            written += stat.st_size
+            job.sample.general.manifest[read] = {'output': outputfile, 'size': stat.st_size,
+                                                 'mtime': stat.st_mtime_ns, 'inputs': job.inputs[read],
+                                                 'format': self.format, 'subsample': report}
+            if self.checksum:
+                job.sample.general.manifest[read]['md5'] = checksums[-1]
+            self.recordstatistics(job.sample, read)
+            if job.cachekeys:
+                metadata = {'subsample': report}
+                if self.statistics:
+                    metadata['statistics'] = job.sample.general.statistics[read]
                 try:
-                    self.execute(mergecommand)
-                except KeyboardInterrupt:
-                    printtime(u'Keyboard interrupt! The system call will not stop until it is finished.', self.start)
-                    self.mergequeue.empty()
-                    try:
-                        os.remove(outputfile)
-                    except IOError:
-                        pass
-                    sys.exit()
-            # Signal to mergequeue that job is done
-            self.mergequeue.task_done()
+                    await loop.run_in_executor(self.executor, partial(
+                        self.cache.store, job.cachekeys[read], outputfile, metadata=metadata))
+                except OSError as exception:
+                    printtime(u'Could not add {} to the cache: {}'.format(outputfile, exception), self.start)
+        # Record the job, and the fraction of the read pairs of the sample that were kept
+        seconds = time() - started
+        self.busy += seconds
+        self.mergedbytes += job.size
+        self.metrics.increment('bytesmerged', job.size)
+        self.metrics.increment('byteswritten', written)
+        self.metrics.increment('mergedfiles', len(reads))
+        self.metrics.event('subsample', sample=str(job.sample.name), output=job.outputfile, bytes=job.size,
+                           written=written, format=self.format, seconds=seconds, wait=started - self.queued,
+                           **report)
+        return job.size
+
+    def fetch(self, sample, read, cachekey, inputs, outputfile):
+        """
+        Retrieve a merged file from the cache
+        :param sample: the sample record
+        :param read: the read direction of the merged file (R1/R2)
+        :param cachekey: the cache key of the merged file
+        :param inputs: list of the path, size, and modification time of each of the input files
+        :param outputfile: the name and path of the merged file
+        :return: boolean of whether the merged file was in the cache
+        """
+        information = self.cache.fetch(cachekey, outputfile, sidecars=['.gzi'] if self.recompress else [],
+                                       metadata=[name for name, required in [('statistics', self.statistics),
+                                                                             ('subsample', self.subsampling)]
+                                                 if required])
+        if information is None:
+            self.metrics.increment('cachemisses')
+            return False
+        # Remove the index of a previous recompressed file, as it does not describe the concatenated file
+        if not self.recompress and os.path.isfile('{}.gzi'.format(outputfile)):
+            os.remove('{}.gzi'.format(outputfile))
+        stat = os.stat(outputfile)
+        sample.general.manifest[read] = {'output': outputfile, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                         'inputs': inputs, 'format': self.format, 'cache': cachekey}
+        if self.statistics:
+            sample.general.statistics[read] = information['statistics']
+        self.recordstatistics(sample, read)
+        if self.subsampling:
+            sample.general.manifest[read]['subsample'] = information['subsample']
+        self.metrics.increment('cachehits')
+        self.metrics.event('cache', sample=str(sample.name), read=read, output=outputfile, key=cachekey)
+        return True
+
+    def completesample(self, sample):
+        """
+        Write the manifest, and optionally the read statistics, of a sample once all its merged files are complete
+        :param sample: the sample record
+        """
+        writemanifest(sample.general.manifestfile, sample.name, sample.general.manifest)
+        if self.statistics:
+            self.pairstatistics(sample)
+        elif os.path.isfile(sample.general.statisticsfile):
+            # The statistics of a previous run no longer describe the merged files
+            os.remove(sample.general.statisticsfile)
+
+    def recordstatistics(self, sample, read):
+        """
+        Record the read statistics of a newly created merged file in its manifest entry, so that they are only ever
+        reused along with the file they describe. Statistics of a previous version of the file are discarded
+        :param sample: the sample record
+        :param read: the read direction of the merged file (R1/R2)
+        """
+        if self.statistics:
+            sample.general.manifest[read]['statistics'] = sample.general.statistics[read]
+        else:
+            sample.general.statistics.pop(read, None)
+
+    def pairstatistics(self, sample):
+        """
+        Check that the forward and reverse merged files of a sample have the same number of reads, and write the read
+        statistics of the sample
+        :param sample: the sample record
+        """
+        import json
+        statistics = sample.general.statistics
+        statistics['paired'] = statistics.get('R1', {}).get('reads') == statistics.get('R2', {}).get('reads')
+        if not statistics['paired']:
+            printtime(u'Warning: {} has {} forward reads, but {} reverse reads'
+                      .format(sample.name, statistics.get('R1', {}).get('reads'),
+                              statistics.get('R2', {}).get('reads')), self.start)
+        temporary = temporaryfile(sample.general.statisticsfile)
+        with open(temporary, 'w') as summary:
+            json.dump(statistics, summary, indent=4, sort_keys=True)
+        os.replace(temporary, sample.general.statisticsfile)
+
+    @staticmethod
+    def uptodate(entry, inputs, outputfile, fileformat):
+        """
+        Determine whether a merged file can be reused, using only a stat of the merged file
+        :param entry: the manifest entry of the merged file from a previous run (None if there is none)
+        :param inputs: list of the path, size, and modification time of each of the current input files
+        :param outputfile: the name and path of the merged file
+        :param fileformat: the format of the merged file to create (concatenated or bgzf)
+        :return: boolean of whether the merged file is complete, and was created from the current inputs
+        """
+        # Manifests written before the format was recorded describe concatenated files
+        if not entry or entry.get('format', 'concatenated') != fileformat:
+            return False
+        try:
+            stat = os.stat(outputfile)
+        except OSError:
+            return False
+        # The merged file must be the one described by the manifest
+        if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            return False
+        # The inputs must be the same files, with the same sizes and modification times. Manifests written before the
+        # paths were recorded in full may have them relative to the working directory of that run
+        return [(os.path.abspath(x['path']), x['size'], x['mtime']) for x in entry['inputs']] == \
+            [(os.path.abspath(x['path']), x['size'], x['mtime']) for x in inputs]
+
+    @staticmethod
+    def device(record):
+        """
+        :param record: the index record of a fastq file
+        :return: the device (st_dev) of the filesystem holding the file
+        """
+        # Indexes persisted before devices were recorded don't have this field
+        if record.get('device') is None:
+            record['device'] = os.stat(record['path']).st_dev
+        return record['device']
 
     def filelink(self):
         # If the creation of a sample sheet is necessary
@@ -165,88 +2495,149 @@ class Merger(object):
                     writesheet.write(''.join(samplesheet))
         # Optionally copy
         if self.copy:
-            import shutil
             make_path('{}/BestAssemblies'.format(self.assemblypath))
+            self.delivermerged()
         # Link the files to the assembly path
-        for sample in self.metadata:
-            try:
-                if self.copy:
-                    shutil.copyfile(sample.general.outputforward, '{}/{}'.format(self.assemblypath,
-                                    os.path.basename(sample.general.outputforward)))
-                    shutil.copyfile(sample.general.outputreverse, '{}/{}'.format(self.assemblypath,
-                                    os.path.basename(sample.general.outputreverse)))
-
-                else:
+        else:
+            for outputfile in self.mergedfiles():
+                try:
                     if self.relativepaths:
-                        relativesymlink(sample.general.outputforward, '{}/{}'.format(self.assemblypath,
-                                        os.path.basename(sample.general.outputforward)))
-                        relativesymlink(sample.general.outputreverse, '{}/{}'.format(self.assemblypath,
-                                        os.path.basename(sample.general.outputreverse)))
+                        relativesymlink(outputfile, '{}/{}'.format(self.assemblypath, os.path.basename(outputfile)))
                     else:
-                        os.symlink(sample.general.outputforward, '{}/{}'.format(self.assemblypath,
-                                   os.path.basename(sample.general.outputforward)))
-                        os.symlink(sample.general.outputreverse, '{}/{}'.format(self.assemblypath,
-                                   os.path.basename(sample.general.outputreverse)))
-            # Except os errors
-            except OSError as exception:
-                # If the os error is anything but directory exists, then raise
-                if exception.errno != errno.EEXIST:
-                    raise
+                        os.symlink(outputfile, '{}/{}'.format(self.assemblypath, os.path.basename(outputfile)))
+                # Except os errors
+                except OSError as exception:
+                    # If the os error is anything but directory exists, then raise
+                    if exception.errno != errno.EEXIST:
+                        raise
         # Remove the BestAssemblies directory if necessary
         if self.copy:
             os.removedirs('{}/BestAssemblies'.format(self.assemblypath))
 
-    def execute(self, command, outfile=""):
+    def mergedfiles(self):
+        """
+        :return: list of the merged files of every sample, followed by the .gzi index of each recompressed file, which
+        downstream tools need to seek within it
+        """
+        outputfiles = [outputfile for sample in self.metadata
+                       for outputfile in [sample.general.outputforward, sample.general.outputreverse]]
+        return outputfiles + ['{}.gzi'.format(outputfile) for outputfile in outputfiles
+                              if os.path.isfile('{}.gzi'.format(outputfile))]
+
+    def delivermerged(self):
+        """
+        Deliver independent copies of the merged files to the assembly path in parallel, with at most :destinationjobs
+        deliveries at a time. Each file is reflinked, hardlinked, or copied, whichever is fastest. The method used and
+        the time taken are reported for every file
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        deliveries = [(outputfile, '{}/{}'.format(self.assemblypath, os.path.basename(outputfile)))
+                      for outputfile in self.mergedfiles()]
+        with ThreadPoolExecutor(max_workers=self.destinationjobs) as executor:
+            for (source, destination), (method, seconds) in zip(deliveries,
+                                                                executor.map(lambda x: deliver(*x), deliveries)):
+                printtime(u'{} is already delivered'.format(os.path.basename(destination)) if method == 'existing'
+                          else u'Delivered {} by {} in {:.2f} s'.format(os.path.basename(destination), method,
+                                                                        seconds), self.start)
+                self.metrics.increment('delivered{}'.format(method))
+                self.metrics.event('delivery', source=source, destination=destination, method=method, seconds=seconds)
+
+    async def execute(self, command, outfile=""):
         """
-        Allows for dots to be printed to the terminal while waiting for a long system call to run
+        Run a system call, and wait for it to finish without polling it
         :param command: the command to be executed
         :param outfile: optional string of an output file
-        from https://stackoverflow.com/questions/4417546/constantly-print-subprocess-output-while-process-is-running
         """
-        import time
-        from subprocess import Popen, PIPE, STDOUT
-        # Initialise the starting time
-        start = int(time.time())
-        maxtime = 0
+        import asyncio
+        from subprocess import CalledProcessError, STDOUT
         # Run the commands - direct stdout to PIPE and stderr to stdout
-        process = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
+        process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=STDOUT)
         # Create the output file - if not provided, then nothing should happen
-        writeout = open(outfile, "ab+") if outfile else ""
-        # Poll process for new output until finished
+        writeout = open(outfile, "ab+") if outfile else None
+        try:
+            # Wait for output until the process closes stdout. Output is always read, so that the process can never
+            # block on a full pipe
+            while True:
+                output = await process.stdout.read(65536)
+                if not output:
+                    break
+                if writeout:
+                    writeout.write(output)
+            await process.wait()
+        except asyncio.CancelledError:
+            # Don't leave the process running if the merge is interrupted
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            # Close the output file
+            if writeout:
+                writeout.close()
+        if process.returncode:
+            raise CalledProcessError(process.returncode, command)
+
+    async def progress(self):
+        """
+        Print a dot to the terminal every ten seconds while merges are running, with up to 80 dots on a line.
+        Alternatively, update a progress line with the bytes merged, the estimated time remaining, and the number of
+        active jobs every second
+        """
+        import asyncio
+        from datetime import timedelta
+        from time import time
         while True:
-            # If an output file name is provided
-            if outfile:
-                # Get stdout into a variable
-                nextline = process.stdout.readline()
-                # Print stdout to the file
-                writeout.write(nextline)
-            # Break from the loop if the command is finished
-            if process.poll() is not None:
-                break
-            # Adding sleep commands slowed down this method when there was lots of output. Difference between the start
-            # time of the analysis and the current time. Action on each second passed
-            currenttime = int(time.time())
-            # As each thread will print a dot at the same time, often the dots printed to the terminal do not look
-            # even. Instead of 80 per line, there are sometimes around 78-82, or just one. Having this random number
-            # seems to fix this
-            from random import randint
-            # Set the number to be a random integer between 0 and 999
-            number = randint(0, 999)
-            if currenttime - start > maxtime + number:
-                # Set the max time for each iteration
-                maxtime = currenttime - start
-                # Print up to 80 dots on a line, with a one second delay between each dot
-                if self.count <= 80:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-                    self.count += 1
-                # Once there are 80 dots on a line, start a new line with the the time
-                else:
-                    sys.stdout.write('\n.')
-                    sys.stdout.flush()
-                    self.count = 1
-        # Close the output file
-        writeout.close() if outfile else ""
+            await asyncio.sleep(1 if self.progressline else 10)
+            if self.progressline:
+                elapsed = time() - self.queued
+                remaining = (self.totalbytes - self.mergedbytes) * elapsed / self.mergedbytes if self.mergedbytes \
+                    else None
+                sys.stdout.write('\r{:.1f}/{:.1f} GB merged ({:.0f}%), ETA {}, {} active jobs   '.format(
+                    self.mergedbytes / 1073741824, self.totalbytes / 1073741824,
+                    100 * self.mergedbytes / self.totalbytes if self.totalbytes else 100,
+                    timedelta(seconds=int(remaining)) if remaining is not None else 'unknown', self.running))
+                sys.stdout.flush()
+                continue
+            if not self.running:
+                continue
+            if self.count <= 80:
+                sys.stdout.write('.')
+                self.count += 1
+            # Once there are 80 dots on a line, start a new line
+            else:
+                sys.stdout.write('\n.')
+                self.count = 1
+            sys.stdout.flush()
+
+    def configure(self, args):
+        """
+        Set how the merged files are created. Workers take these settings from each task, so that a task is merged in
+        the same way whichever host runs it
+        :param args: dictionary of the arguments (any of those in SPOOLARGUMENTS)
+        """
+        # Set the method used to concatenate the files
+        self.backend = args.get('backend') or 'native'
+        # Determine whether checksums of the files should be recorded in the manifests
+        self.checksum = args.get('checksum', False)
+        # Determine whether the reads should be recompressed into BGZF files rather than concatenated
+        self.recompress = args.get('recompress', False)
+        self.format = 'bgzf' if self.recompress else 'concatenated'
+        # Optionally subsample the read pairs of each sample to a number of pairs, or to a coverage of the genome
+        self.subsample = args.get('subsample')
+        self.genomesize = args.get('genomesize')
+        self.coverage = args.get('coverage')
+        self.targetbases = int(self.genomesize * self.coverage) if self.genomesize and self.coverage else None
+        self.seed = args.get('seed') or 0
+        self.subsampling = bool(self.subsample or self.targetbases)
+        if self.subsampling:
+            # The target and seed are part of the format, so changing either creates the subsamples again
+            self.format = 'subsampled({}={},seed={})'.format('bases' if self.targetbases else 'pairs',
+                                                             self.targetbases or self.subsample, self.seed)
+        # Determine whether read statistics should be collected while merging
+        self.statistics = args.get('statistics', False)
+        # Optionally share merged files between requests through a content-addressed cache
+        self.cache = MergeCache(args['cache'], int(args['cachesize'] * 1073741824) if args.get('cachesize') else None) \
+            if args.get('cache') else None
 
     def __init__(self, args, start):
         """
@@ -254,12 +2645,42 @@ class Merger(object):
         :param start: the start time
         Initialises the variables required for this class
         """
-        from queue import Queue
-        import multiprocessing
+        import socket
         # Define variables from the arguments - there may be a more streamlined way to do this
         self.args = args
-        self.path = os.path.join(args['path'], "")
+        # The paths of the files are sent to workers, which may run in any directory on any host, and recorded in the
+        # manifests, so they are all absolute
+        self.path = os.path.join(os.path.abspath(args['path']), "")
+        if args.get('cache'):
+            args['cache'] = os.path.abspath(args['cache'])
         self.start = start
+        # Set the total number of concurrent merges, and the number allowed to use each source and destination
+        # filesystem. As merging is I/O-bound, the total is only limited by the filesystem limits unless requested
+        self.cpus = args.get('threads')
+        self.sourcejobs = args.get('sourcejobs') or 4
+        self.destinationjobs = args.get('destinationjobs') or 4
+        self.autotune = args.get('autotune', False)
+        # Set how the merged files are created
+        self.configure(args)
+        # Determine whether (and how thoroughly) to verify the input files before merging
+        self.verification = args.get('verify')
+        # Determine whether to write manifests of virtual merges rather than merging the files
+        self.virtual = args.get('virtual', False)
+        # Determine whether to print a progress line rather than dots while merging
+        self.progressline = args.get('progress', False)
+        # Record timing spans, byte counters, and job events in a JSON lines file in the path, unless disabled. Each
+        # worker has its own file in the spool directory
+        self.worker = '{}.{}'.format(socket.gethostname(), os.getpid())
+        self.metrics = Metrics(None if args.get('nometrics') else
+                               args.get('metrics') or '{}merger_metrics{}.jsonl'
+                               .format(self.path, '.{}'.format(self.worker) if args.get('worker') else ''))
+        self.count = 0
+        # Workers merge the tasks in a spool directory (the path) rather than the samples of a seq ID file
+        if args.get('worker'):
+            self.spool = Spool(self.path, args.get('spooltimeout') or 120)
+            self.work(args.get('idle') or 60)
+            self.metrics.close()
+            sys.exit()
         # Determine which seq ID file to use
         # If an argument for the file is provided, use it
         if args['f']:
@@ -271,8 +2692,10 @@ class Merger(object):
                                                     'arguments'
         # If no argument is provided, try to find the file
         else:
-            # Look for .txt, .tsv, or .csv files
-            self.idfile = map(lambda x: glob('{}*{}'.format(self.path, x)), ['.txt', '.csv', '.tsv'])
+            # Look for .txt, .tsv, or .csv files, ignoring the tables written by previous runs of the merger
+            reports = {'{}{}'.format(self.path, report) for report in ['readstatistics.tsv', 'subsampling.tsv']}
+            self.idfile = map(lambda x: [idfile for idfile in glob('{}*{}'.format(self.path, x))
+                                         if idfile not in reports], ['.txt', '.csv', '.tsv'])
             # Initialise the file count
             filecount = 0
             # Iterate through each extension
@@ -302,27 +2725,47 @@ class Merger(object):
             self.delimiter = ','
         # Determine if sorting the columns is desired
         self.sort = args['Sort']
+        # Determine whether the index of the fastq files should be stored in the path for subsequent runs
+        self.persistindex = args.get('persistindex', False)
         # Initialise class variables
         self.seqids = ""
         self.seqfiles = list()
         self.data = list()
-        self.cpus = multiprocessing.cpu_count()
-        self.mergequeue = Queue(maxsize=self.cpus)
+        # Optionally run the merges as tasks in a spool directory shared with workers on any number of hosts
+        self.spool = Spool(args['spool'], args.get('spooltimeout') or 120) if args.get('spool') else None
+        self.workers = args.get('workers') or 0
         self.count = 0
         self.metadata = list()
         # Find which IDs need to be merged together from the text file
-        self.idseek()
+        with self.metrics.span('idseek'):
+            self.idseek()
         # Find the files corresponding to the IDs
-        self.idfind()
+        with self.metrics.span('idfind'):
+            self.idfind()
+        self.metrics.increment('samples', len(self.metadata))
+        self.metrics.increment('inputfiles', len(self.index.records))
+        # Optionally check the integrity of the files before merging them
+        if self.verification:
+            with self.metrics.span('verify'):
+                self.verify()
         # Merge the files together
-        self.idmerge()
+        try:
+            with self.metrics.span('idmerge'):
+                self.idmerge()
+        finally:
+            # Store the index once this run has created its sample directories (and the verification cache) in the
+            # path, as they change the modification time of the directory, and would make the index stale
+            if self.persistindex:
+                self.index.save()
         # Exit
         printtime(u'Files have been successfully merged.', self.start)
         # Set the optional arguments
         self.copy = args['copy'] if args['copy'] else False
         self.relativepaths = args['relativePaths'] if args['relativePaths'] else False
-        # Optionally run the file linking method
-        if args['linkFiles'] or args['copy']:
+        # Optionally run the file linking method. Virtual merges have no files to link
+        if self.virtual and (args['linkFiles'] or args['copy']):
+            printtime(u'Virtual merges have no merged files to link to the assembly folder', self.start)
+        elif args['linkFiles'] or args['copy']:
             # Create the assembly folder and path from the supplied arguments
             self.assemblyfolder = args['o'] if args['o'] else self.path.split('/')[-2]
             self.assemblypath = os.path.join(args['a'], "") + self.assemblyfolder
@@ -331,8 +2774,10 @@ class Merger(object):
                                                      'your supplied arguments'
             self.samplesheet = args['samplesheet']
             # Run the linking
-            self.filelink()
+            with self.metrics.span('filelink'):
+                self.filelink()
             printtime(u'Files have been successfully linked to the assembly folder. Analysis complete.', self.start)
+        self.metrics.close()
         sys.exit()
 
 # If the script is called from the command line, then call the argument parser
@@ -400,9 +2845,127 @@ if __name__ == '__main__':
                         '--copy',
                         action='store_true',
                         help='Copies rather than symbolically linking the files to the destination folder')
+    parser.add_argument('-b',
+                        '--backend',
+                        choices=['native', 'shell'],
+                        default='native',
+                        help='The method used to concatenate the files. "native" (default) appends the files in-process'
+                             ' using kernel copies (copy_file_range/sendfile) where possible. "shell" runs a cat command'
+                             ' for each merged file, and is only kept as a fallback')
+    parser.add_argument('-i',
+                        '--persistindex',
+                        action='store_true',
+                        help='Store the index of the .fastq files in the path (.fastqindex.json), and reuse it on '
+                             'subsequent runs as long as no files have been added to or removed from the path')
+    parser.add_argument('-t',
+                        '--threads',
+                        type=int,
+                        help='The maximum number of files to merge at the same time. Default is as many as the '
+                             '--sourcejobs and --destinationjobs limits of the filesystems in use allow')
+    parser.add_argument('--sourcejobs',
+                        type=int,
+                        default=4,
+                        help='The maximum number of merges reading from a single filesystem at the same time. '
+                             'Default is 4')
+    parser.add_argument('--destinationjobs',
+                        type=int,
+                        default=4,
+                        help='The maximum number of merges writing to a single filesystem at the same time. '
+                             'Default is 4')
+    parser.add_argument('--autotune',
+                        action='store_true',
+                        help='Tune the number of merges using each filesystem (up to the limits above) from the '
+                             'observed throughput')
+    parser.add_argument('--checksum',
+                        action='store_true',
+                        help='Record MD5 checksums of the input files and the merged files in the manifest written '
+                             'for each merged sample')
+    parser.add_argument('--recompress',
+                        action='store_true',
+                        help='Decompress the reads, and recompress them in parallel into BGZF files (readable as '
+                             'ordinary .fastq.gz files) with a .gzi block index, rather than concatenating the files')
+    parser.add_argument('--statistics',
+                        action='store_true',
+                        help='Collect the read count, base count and composition, length distribution, and mean '
+                             'quality of each merged file while merging. Requires NumPy')
+    parser.add_argument('--verify',
+                        choices=['fast', 'full'],
+                        help='Check the integrity of the .fastq.gz files before merging. "fast" checks the gzip '
+                             'header, and walks every block of BGZF files, but only finds truncated gzip files that '
+                             'are not BGZF if they are smaller than about 4 MB. "full" decompresses every file, '
+                             'checking the CRC of each gzip member, and finds any truncated file. Verified files are '
+                             'not checked again')
+    parser.add_argument('--virtual',
+                        action='store_true',
+                        help='Write a manifest of the files to merge for each sample (sample_virtual.json) rather '
+                             'than merging them. The manifests can be opened with merger.MergedSample to stream the '
+                             'merged reads')
+    parser.add_argument('--subsample',
+                        type=int,
+                        help='Keep a random subsample of this many read pairs of each sample. The forward and reverse '
+                             'files keep the same pairs')
+    parser.add_argument('--genomesize',
+                        type=float,
+                        help='The genome size in bases. With --coverage, keep a random subsample of the read pairs '
+                             'of each sample giving that coverage of the genome')
+    parser.add_argument('--coverage',
+                        type=float,
+                        help='The coverage of the genome to keep when subsampling. Requires --genomesize')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='The seed of the random subsampling. The same seed and input files always give the same '
+                             'subsample. Default is 0')
+    parser.add_argument('--cache',
+                        help='A directory of merged files shared between requests. Merges of the same input files are '
+                             'linked from the cache rather than merged again')
+    parser.add_argument('--cachesize',
+                        type=float,
+                        help='The maximum size of the cache in GB. The least recently used merged files are removed '
+                             'once the cache is larger. Default is unlimited')
+    parser.add_argument('--spool',
+                        help='A directory on storage shared between hosts. The merges are written to it as tasks for '
+                             'workers started with --worker, and this run waits for them to be completed')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='The number of workers to start on this host to merge the tasks in the spool. Requires '
+                             '--spool. Default is none')
+    parser.add_argument('--worker',
+                        action='store_true',
+                        help='Run as a worker: the path is a spool directory, and its tasks are merged until there '
+                             'have been none for --idle seconds. Start any number of workers on any number of hosts')
+    parser.add_argument('--idle',
+                        type=float,
+                        default=60,
+                        help='The number of seconds without any tasks after which a worker stops. Default is 60')
+    parser.add_argument('--spooltimeout',
+                        type=float,
+                        default=120,
+                        help='The number of seconds without a heartbeat from a worker after which its tasks are '
+                             'returned to the spool for other workers. Default is 120')
+    parser.add_argument('-p',
+                        '--progress',
+                        action='store_true',
+                        help='Show a progress line with the bytes merged, the estimated time remaining, and the number '
+                             'of active jobs instead of printing dots')
+    parser.add_argument('-m',
+                        '--metrics',
+                        help='The name and path of the JSON lines file to which timings, byte counts, and the '
+                             'throughput of each merge are written. Default is merger_metrics.jsonl in the path')
+    parser.add_argument('--nometrics',
+                        action='store_true',
+                        help='Don\'t write the metrics file')
 
     # Get the arguments into a list
     arguments = vars(parser.parse_args())
+    if arguments['workers'] and not arguments['spool']:
+        parser.error('--workers requires --spool')
+    if bool(arguments['genomesize']) != bool(arguments['coverage']):
+        parser.error('--genomesize and --coverage must be used together')
+    if arguments['subsample'] and arguments['genomesize']:
+        parser.error('--subsample cannot be used with --genomesize and --coverage')
+    if (arguments['subsample'] or arguments['genomesize']) and (arguments['recompress'] or arguments['virtual']):
+        parser.error('Subsampled files cannot be recompressed or virtual')
     # Get the starting time for use in print statements
     starttime = time()
     # Run the pipeline